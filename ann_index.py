@@ -0,0 +1,212 @@
+# Approximate Nearest-Neighbour Index
+# Inverted-file (IVF) index over unit face encodings for large galleries
+
+import copy
+import numpy as np
+
+ASSIGN_CHUNK = 8192  # Rows scored against the centroids at a time
+
+
+def assign_to_centroids(data, centroids, chunk=ASSIGN_CHUNK):
+    """Index of the most similar centroid for every row of `data`"""
+    labels = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk]
+        labels[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+def spherical_kmeans(data, k, iterations=10, seed=0):
+    """
+    Cluster unit vectors by cosine similarity
+
+    Args:
+        data: (N, D) float32 unit rows
+        k: Number of clusters (clamped to N)
+        iterations: Lloyd iterations
+        seed: Random seed for the initial centroids
+
+    Returns:
+        (k, D) float32 unit centroids
+    """
+    rng = np.random.default_rng(seed)
+    k = max(1, min(k, len(data)))
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = assign_to_centroids(data, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=k)
+
+        # Re-seed empty clusters from random points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = (sums / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+    return centroids
+
+
+class IVFIndex:
+    """
+    Inverted-file index with k-means coarse centroids
+
+    Each gallery encoding lives in the list of its nearest centroid. A query
+    scores the centroids, then only the vectors in the `nprobe` closest
+    lists, so the scan touches roughly nprobe / nlist of the gallery.
+    Lists keep their own copies of the unit vectors and norms so the index
+    stays valid while gallery rows move around.
+    """
+
+    def __init__(self, nlist=None, nprobe=8, train_sample=50000, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.train_sample = train_sample
+        self.seed = seed
+        self.centroids = None
+        self.trained_size = 0
+        self.size = 0
+        self._lists = []     # [{"keys": list, "vectors": ndarray, "norms": ndarray, "count": int}]
+        self._list_of = {}   # {template_key: (list_no, position)}
+
+    @staticmethod
+    def default_nlist(n):
+        """Number of coarse cells for a gallery of size n (~4 * sqrt(n))"""
+        return max(1, int(4 * np.sqrt(n)))
+
+    def build(self, gallery):
+        """Train the coarse quantizer on a gallery and index all its live rows"""
+        live = np.flatnonzero(gallery.alive)
+        matrix = gallery.matrix[live]
+        n = len(matrix)
+        nlist = self.nlist or self.default_nlist(n)
+
+        rng = np.random.default_rng(self.seed)
+        if n > self.train_sample:
+            sample = matrix[rng.choice(n, self.train_sample, replace=False)]
+        else:
+            sample = matrix
+        self.centroids = spherical_kmeans(sample, nlist, seed=self.seed)
+
+        labels = assign_to_centroids(matrix, self.centroids)
+        keys = gallery.keys[live]
+        norms = gallery.norms[live]
+        self._lists = []
+        self._list_of = {}
+        for list_no in range(len(self.centroids)):
+            members = np.flatnonzero(labels == list_no)
+            entry = {
+                "keys": [int(keys[row]) for row in members],
+                "vectors": np.ascontiguousarray(matrix[members]),
+                "norms": norms[members].copy(),
+                "count": len(members),
+            }
+            for position, key in enumerate(entry["keys"]):
+                self._list_of[key] = (list_no, position)
+            self._lists.append(entry)
+
+        self.size = n
+        self.trained_size = n
+        return self
+
+    def is_trained(self):
+        return self.centroids is not None
+
+    def needs_retrain(self):
+        """True once the gallery has doubled since the centroids were fitted"""
+        return self.size > 2 * max(self.trained_size, 1)
+
+    def snapshot(self, gallery=None):
+        """
+        Read-only copy for a gallery snapshot
+
+        List entries are copy-on-write (add and remove publish a new entry
+        dict instead of editing the old one), so the copy only needs its
+        own list of entries.
+        """
+        frozen = copy.copy(self)
+        frozen._lists = list(self._lists)
+        return frozen
+
+    def add(self, key, unit, norm):
+        """Insert one unit template encoding into its nearest list"""
+        if key in self._list_of:
+            self.remove(key)
+        list_no = int(np.argmax(self.centroids @ unit))
+        entry = dict(self._lists[list_no])
+        count = entry["count"]
+        if count == len(entry["vectors"]):
+            capacity = max(8, 2 * count)
+            vectors = np.zeros((capacity, len(unit)), dtype=np.float32)
+            vectors[:count] = entry["vectors"][:count]
+            norms = np.zeros(capacity, dtype=np.float32)
+            norms[:count] = entry["norms"][:count]
+            entry["vectors"], entry["norms"] = vectors, norms
+        # Slot `count` is past the end of every published copy of this list
+        entry["vectors"][count] = unit
+        entry["norms"][count] = norm
+        entry["keys"] = entry["keys"] + [key]
+        entry["count"] = count + 1
+        self._lists[list_no] = entry
+        self._list_of[key] = (list_no, count)
+        self.size += 1
+
+    def remove(self, key):
+        """Drop a template, moving the list's last entry into its slot (in a new copy)"""
+        location = self._list_of.pop(key, None)
+        if location is None:
+            return False
+        list_no, position = location
+        old = self._lists[list_no]
+        last = old["count"] - 1
+        entry = {
+            "keys": old["keys"][:last],
+            "vectors": old["vectors"][:last].copy(),
+            "norms": old["norms"][:last].copy(),
+            "count": last,
+        }
+        if position != last:
+            moved = old["keys"][last]
+            entry["vectors"][position] = old["vectors"][last]
+            entry["norms"][position] = old["norms"][last]
+            entry["keys"][position] = moved
+            self._list_of[moved] = (list_no, position)
+        self._lists[list_no] = entry
+        self.size -= 1
+        return True
+
+    def candidates(self, unit, nprobe=None):
+        """
+        Score the vectors in the lists nearest to a probe
+
+        Args:
+            unit: (D,) unit probe encoding
+            nprobe: Number of lists to scan (defaults to self.nprobe)
+
+        Returns:
+            Tuple of (template_keys, similarities, norms) for the scanned vectors
+        """
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_sims = self.centroids @ unit
+        if nprobe < len(centroid_sims):
+            probed = np.argpartition(-centroid_sims, nprobe - 1)[:nprobe]
+        else:
+            probed = np.arange(len(centroid_sims))
+
+        keys, similarities, norms = [], [], []
+        for list_no in probed:
+            entry = self._lists[list_no]
+            count = entry["count"]
+            if count == 0:
+                continue
+            keys.extend(entry["keys"])
+            similarities.append(entry["vectors"][:count] @ unit)
+            norms.append(entry["norms"][:count])
+
+        if not similarities:
+            empty = np.empty(0, dtype=np.float32)
+            return [], empty, empty
+        return keys, np.concatenate(similarities), np.concatenate(norms)
@@ -0,0 +1,332 @@
+# Matching Benchmarks
+# Synthetic-gallery benchmarks for the matching and image pipeline
+#
+# Usage:
+#   python benchmark.py ann [--faces 100000] [--queries 500]
+#   python benchmark.py pq [--faces 100000] [--queries 500]
+#   python benchmark.py pca [--faces 100000] [--queries 500]
+#   python benchmark.py shards [--faces 200000] [--queries 200]
+#   python benchmark.py mmap [--faces 200000] [--queries 100]
+#   python benchmark.py detect [--images captured_faces] [--upscale 1.0]
+#   python benchmark.py decode [--repeats 20]
+#   python benchmark.py encode [--repeats 200]
+
+import argparse
+import io
+import os
+import tempfile
+import time
+import numpy as np
+from PIL import Image
+
+from gallery import Gallery, PQGallery, MemmapGallery, ENCODING_SIZE
+from ann_index import IVFIndex
+from pq import ProductQuantizer
+from pca_cascade import PCACascade
+from sharded_search import ShardedSearcher
+import face_service
+from face_service import search_gallery, detect_faces, Frame, encode_face, encode_faces
+from decoders import DECODERS, decoder_available
+
+
+def synthetic_gallery(n, seed=0):
+    """Gallery of n random identities plus the raw encodings"""
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(size=(n, ENCODING_SIZE)).astype(np.float32)
+    faces = {
+        str(i + 1): {"name": f"person_{i + 1}", "encodings": [encodings[i]]}
+        for i in range(n)
+    }
+    return Gallery.from_faces(faces), encodings
+
+
+def synthetic_probes(encodings, count, noise=0.35, seed=1):
+    """Noisy re-captures of random enrolled identities"""
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(encodings), count, replace=False)
+    probes = encodings[picks] + noise * rng.normal(size=(count, encodings.shape[1]))
+    return probes.astype(np.float32), picks
+
+
+def timed_search(gallery, probes, k=1):
+    """Run every probe through search_gallery, returning top rows and ms/query"""
+    results = []
+    start = time.perf_counter()
+    for probe in probes:
+        rows, _ = search_gallery(gallery, probe, k)
+        results.append(rows)
+    elapsed = (time.perf_counter() - start) * 1000 / len(probes)
+    return results, elapsed
+
+
+def bench_ann(args):
+    """Recall and latency of the IVF index against the exact scan"""
+    gallery, encodings = synthetic_gallery(args.faces)
+    probes, _ = synthetic_probes(encodings, args.queries)
+
+    exact, exact_ms = timed_search(gallery, probes)
+    print(f"Gallery: {args.faces} faces, {args.queries} queries")
+    print(f"  exact           {exact_ms:8.3f} ms/query  recall@1 1.000")
+
+    start = time.perf_counter()
+    index = gallery.attach_index(IVFIndex(nlist=args.nlist))
+    build_s = time.perf_counter() - start
+    print(f"  IVF build       {build_s:8.2f} s  ({len(index.centroids)} lists)")
+
+    for nprobe in (1, 2, 4, 8, 16, 32):
+        index.nprobe = nprobe
+        approx, approx_ms = timed_search(gallery, probes)
+        recall = np.mean([
+            len(a) > 0 and a[0] == e[0] for a, e in zip(approx, exact)
+        ])
+        print(f"  ivf nprobe={nprobe:<3} {approx_ms:8.3f} ms/query  recall@1 {recall:.3f}  "
+              f"speedup {exact_ms / approx_ms:5.1f}x")
+
+
+def bench_pq(args):
+    """Memory, recall and latency of product-quantized storage"""
+    gallery, encodings = synthetic_gallery(args.faces)
+    probes, _ = synthetic_probes(encodings, args.queries)
+    exact, exact_ms = timed_search(gallery, probes)
+    float_bytes = gallery.matrix.nbytes + gallery.norms.nbytes
+    print(f"Gallery: {args.faces} faces, {args.queries} queries")
+    print(f"  float32         {exact_ms:8.3f} ms/query  {float_bytes / 2**20:8.1f} MB")
+
+    for subspaces in (8, 16, 32):
+        start = time.perf_counter()
+        quantizer = ProductQuantizer(subspaces=subspaces)
+        quantizer.train(gallery.matrix[:args.train])
+        train_s = time.perf_counter() - start
+
+        faces = {
+            person_id: {"name": name, "encodings": [encodings[row]]}
+            for row, (person_id, name) in enumerate(zip(gallery.ids, gallery.names))
+        }
+        compressed = PQGallery.from_faces(faces, quantizer=quantizer)
+        approx, approx_ms = timed_search(compressed, probes)
+        recall = np.mean([a[0] == e[0] for a, e in zip(approx, exact)])
+        pq_bytes = compressed.codes.nbytes + compressed.norms.nbytes
+        print(f"  pq m={subspaces:<3}        {approx_ms:8.3f} ms/query  {pq_bytes / 2**20:8.1f} MB  "
+              f"recall@1 {recall:.3f}  (train {train_s:.1f} s)")
+
+
+def bench_pca(args):
+    """Speedup of the PCA cascade and the shortlist needed to match exact search"""
+    gallery, encodings = synthetic_gallery(args.faces)
+    probes, _ = synthetic_probes(encodings, args.queries)
+    exact, exact_ms = timed_search(gallery, probes)
+    print(f"Gallery: {args.faces} faces, {args.queries} queries")
+    print(f"  exact               {exact_ms:8.3f} ms/query")
+
+    cascade = gallery.attach_index(PCACascade(dims=args.dims))
+    zero_change = None
+    for shortlist in (10, 25, 50, 100, 200, 400, 800):
+        cascade.shortlist = shortlist
+        approx, approx_ms = timed_search(gallery, probes)
+        changes = sum(a[0] != e[0] for a, e in zip(approx, exact))
+        if changes == 0 and zero_change is None:
+            zero_change = shortlist
+        print(f"  pca{args.dims} shortlist={shortlist:<4} {approx_ms:8.3f} ms/query  "
+              f"decision changes {changes:<4} speedup {exact_ms / approx_ms:5.1f}x")
+    print(f"  smallest shortlist with zero decision changes: {zero_change}")
+
+
+def bench_shards(args):
+    """Exact-scan latency as the gallery is split across more worker threads"""
+    gallery, encodings = synthetic_gallery(args.faces)
+    probes, _ = synthetic_probes(encodings, args.queries)
+    face_service.sharded_searcher = None
+    exact, single_ms = timed_search(gallery, probes)
+    print(f"Gallery: {args.faces} faces, {args.queries} queries")
+    print(f"  1 shard        {single_ms:8.3f} ms/query")
+
+    face_service.SHARD_MIN_ROWS = 0
+    for shards in (2, 4, 8, 16):
+        face_service.sharded_searcher = ShardedSearcher(shards)
+        results, sharded_ms = timed_search(gallery, probes)
+        mismatches = sum(r[0] != e[0] for r, e in zip(results, exact))
+        print(f"  {shards:<2} shards      {sharded_ms:8.3f} ms/query  "
+              f"speedup {single_ms / sharded_ms:5.1f}x  mismatches {mismatches}")
+
+
+def bench_mmap(args):
+    """Chunked out-of-core scan vs the in-memory exact scan"""
+    gallery, encodings = synthetic_gallery(args.faces)
+    probes, _ = synthetic_probes(encodings, args.queries)
+    exact, exact_ms = timed_search(gallery, probes)
+    print(f"Gallery: {args.faces} faces, {args.queries} queries "
+          f"({gallery.matrix.nbytes / 2**20:.1f} MB of encodings)")
+    print(f"  in-memory          {exact_ms:8.3f} ms/query")
+
+    faces = {
+        person_id: {"name": name, "encodings": [encodings[row]]}
+        for row, (person_id, name) in enumerate(zip(gallery.ids, gallery.names))
+    }
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "gallery.npy")
+        for chunk_rows in (4096, 16384, 65536):
+            mapped = MemmapGallery.from_faces(faces, path=path, chunk_rows=chunk_rows)
+            mapped.flush()
+            results, mapped_ms = timed_search(mapped, probes)
+            mismatches = sum(r[0] != e[0] for r, e in zip(results, exact))
+            block_mb = chunk_rows * ENCODING_SIZE * 4 / 2**20
+            print(f"  mmap chunk={chunk_rows:<6} {mapped_ms:8.3f} ms/query  "
+                  f"{block_mb:5.1f} MB/block  mismatches {mismatches}")
+            del mapped
+
+
+def load_images(folder, upscale=1.0):
+    """RGB arrays of every .jpg/.png under `folder`, optionally enlarged"""
+    images = []
+    for root, _, files in os.walk(folder):
+        for filename in sorted(files):
+            if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+                image = Image.open(os.path.join(root, filename)).convert('RGB')
+                if upscale != 1.0:
+                    image = image.resize((round(image.width * upscale), round(image.height * upscale)))
+                images.append(np.asarray(image))
+    return images
+
+
+def bench_detect(args):
+    """Detection latency and hit rate at several downscale caps"""
+    images = load_images(args.images, args.upscale)
+    if not images:
+        print(f"No images found in {args.images} (capture some with capture_faces.py)")
+        return
+    pixels = np.mean([image.shape[0] * image.shape[1] for image in images])
+    print(f"{len(images)} images, {pixels / 1e6:.2f} MP average, "
+          f"detector {face_service.active_detector()}")
+    face_service.warm_detector()
+
+    for cap in args.caps:
+        found = 0
+        start = time.perf_counter()
+        for image in images:
+            found += bool(detect_faces(image, max_side=cap or None))
+        elapsed = (time.perf_counter() - start) * 1000 / len(images)
+        label = f"max side {cap}" if cap else "full size"
+        print(f"  {label:<14} {elapsed:8.2f} ms/image  hit rate {found / len(images):.3f}")
+
+
+def synthetic_jpeg(width, height, seed=0):
+    """JPEG bytes of a smooth random image (compresses like a photo, unlike noise)"""
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray((rng.random((height // 16, width // 16, 3)) * 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    coarse.resize((width, height), Image.BICUBIC).save(buffer, 'JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def timed_decode(decode, data, repeats):
+    """Milliseconds per call and the size of the arrays produced"""
+    arrays = decode(data)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        decode(data)
+    elapsed = (time.perf_counter() - start) * 1000 / repeats
+    return elapsed, sum(a.nbytes for a in arrays) / 2**20
+
+
+def frame_planes(frame):
+    """Both arrays a matched probe decodes: gray for detection, RGB for encoding"""
+    return [frame.gray, frame.rgb]
+
+
+def bench_decode(args):
+    """Old full-size PIL decode vs reduced decoding with each backend"""
+    def full(data):
+        image = Image.open(io.BytesIO(data))
+        return [np.array(image)]
+
+    backends = [name for name in DECODERS if decoder_available(name)]
+    for width, height in ((640, 480), (1920, 1080), (3000, 2000), (4000, 3000)):
+        data = synthetic_jpeg(width, height)
+        print(f"{width}x{height} JPEG ({len(data) / 2**20:.1f} MB), decoded at 1/{Frame(data).reduce}")
+        full_ms, full_mb = timed_decode(full, data, args.repeats)
+        print(f"  full PIL decode      {full_ms:8.2f} ms  {full_mb:6.1f} MB of arrays")
+        for name in backends:
+            decode = DECODERS[name]
+            gray_ms, _ = timed_decode(lambda d: [Frame(d, decode=decode).gray], data, args.repeats)
+            both_ms, both_mb = timed_decode(lambda d: frame_planes(Frame(d, decode=decode)), data, args.repeats)
+            print(f"  {name:<7} gray        {gray_ms:8.2f} ms")
+            print(f"  {name:<7} gray + rgb  {both_ms:8.2f} ms  {both_mb:6.1f} MB of arrays  "
+                  f"speedup {full_ms / both_ms:4.1f}x")
+
+
+def bench_encode(args):
+    """One encode_face call per face vs a single encode_faces call"""
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 256, (720, 1280, 3), dtype=np.uint8)
+    for faces in (1, 4, 16):
+        sizes = rng.integers(60, 240, faces)
+        locations = [
+            (int(top), int(left + size), int(top + size), int(left))
+            for top, left, size in zip(rng.integers(0, 480, faces), rng.integers(0, 1040, faces), sizes)
+        ]
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            [encode_face(image, location) for location in locations]
+        loop_ms = (time.perf_counter() - start) * 1000 / args.repeats
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            encode_faces(image, locations)
+        batch_ms = (time.perf_counter() - start) * 1000 / args.repeats
+        print(f"{faces:3d} faces: per-face {loop_ms:7.3f} ms  batched {batch_ms:7.3f} ms  "
+              f"({batch_ms / faces * 1000:6.1f} us/face)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Door Lock matching benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    ann = commands.add_parser("ann", help="IVF index recall vs exact search")
+    ann.add_argument("--faces", type=int, default=100000)
+    ann.add_argument("--queries", type=int, default=500)
+    ann.add_argument("--nlist", type=int, default=None)
+    ann.set_defaults(func=bench_ann)
+
+    pq = commands.add_parser("pq", help="Product-quantized storage vs float32")
+    pq.add_argument("--faces", type=int, default=100000)
+    pq.add_argument("--queries", type=int, default=500)
+    pq.add_argument("--train", type=int, default=20000)
+    pq.set_defaults(func=bench_pq)
+
+    pca = commands.add_parser("pca", help="PCA coarse-to-fine cascade vs exact search")
+    pca.add_argument("--faces", type=int, default=100000)
+    pca.add_argument("--queries", type=int, default=500)
+    pca.add_argument("--dims", type=int, default=32)
+    pca.set_defaults(func=bench_pca)
+
+    shards = commands.add_parser("shards", help="Sharded multi-core exact search")
+    shards.add_argument("--faces", type=int, default=200000)
+    shards.add_argument("--queries", type=int, default=200)
+    shards.set_defaults(func=bench_shards)
+
+    mmap = commands.add_parser("mmap", help="Out-of-core chunked scan vs in-memory")
+    mmap.add_argument("--faces", type=int, default=200000)
+    mmap.add_argument("--queries", type=int, default=100)
+    mmap.set_defaults(func=bench_mmap)
+
+    detect = commands.add_parser("detect", help="Downscaled detection latency and hit rate")
+    detect.add_argument("--images", default="captured_faces")
+    detect.add_argument("--upscale", type=float, default=1.0,
+                        help="Enlarge the images first (simulates large browser uploads)")
+    detect.add_argument("--caps", type=int, nargs="+", default=[0, 1280, 960, 640, 480, 320],
+                        help="Longer-side caps to test (0 = full size)")
+    detect.set_defaults(func=bench_detect)
+
+    decode = commands.add_parser("decode", help="Full vs reduced JPEG decoding per backend")
+    decode.add_argument("--repeats", type=int, default=20)
+    decode.set_defaults(func=bench_decode)
+
+    encode = commands.add_parser("encode", help="Per-face vs batched face encoding")
+    encode.add_argument("--repeats", type=int, default=200)
+    encode.set_defaults(func=bench_encode)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
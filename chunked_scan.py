@@ -0,0 +1,47 @@
+# Out-of-Core Chunked Scan
+# Exact top-k over a memory-mapped gallery with bounded working memory
+
+import numpy as np
+
+
+def chunked_topk(gallery, unit, probe_norm, k, to_distance):
+    """
+    Exact k nearest live rows of a MemmapGallery, streamed chunk by chunk
+
+    Each chunk of `gallery.chunk_rows` rows is read from the file, scored
+    with one blocked matrix-vector product and folded into a running top-k,
+    so working memory is bounded by the chunk size, not the gallery size.
+
+    Args:
+        gallery: MemmapGallery to scan
+        unit: (D,) unit probe encoding
+        probe_norm: Original length of the probe
+        k: Rows to return
+        to_distance: similarity_to_distance(similarities, norms, probe_norm)
+
+    Returns:
+        Tuple of (rows, distances) as numpy arrays, nearest first
+    """
+    best_rows = np.empty(0, dtype=np.int64)
+    best_distances = np.empty(0, dtype=np.float32)
+    alive = gallery.alive
+    norms = gallery.norms
+
+    for start in range(0, gallery.size, gallery.chunk_rows):
+        stop = min(start + gallery.chunk_rows, gallery.size)
+        block = np.asarray(gallery._store[start:stop])
+        distances = to_distance(block @ unit, norms[start:stop], probe_norm)
+        distances = np.where(alive[start:stop], distances, np.inf)
+
+        # Merge this chunk's candidates with the running top-k
+        rows = np.concatenate([best_rows, np.arange(start, stop)])
+        distances = np.concatenate([best_distances, distances])
+        if len(distances) > k:
+            keep = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[keep], distances[keep]
+        best_rows, best_distances = rows, distances.astype(np.float32)
+
+    live = np.isfinite(best_distances)
+    best_rows, best_distances = best_rows[live], best_distances[live]
+    order = np.argsort(best_distances, kind='stable')
+    return best_rows[order], best_distances[order]
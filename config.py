@@ -8,10 +8,71 @@ DEBUG = True
 
 # Face recognition settings
 RECOGNITION_THRESHOLD = 0.6  # Lower = stricter (0.4-0.7 recommended)
+FACE_DETECTOR = "auto"  # "auto", "hog" (face_recognition), "haar", "lbp" or "mock"
+DETECTOR_POOL_SIZE = 4  # Pre-loaded cascade classifiers shared by request threads
+DETECT_MAX_SIDE = 640  # Detect on a copy downscaled to this longer side (None = full size)
+DECODE_MAX_SIDE = 1280  # Larger uploads are decoded at 1/2, 1/4 or 1/8 scale (None = full size)
+IMAGE_DECODER = "auto"  # "auto", "opencv" (cv2.imdecode on the request bytes) or "pil"
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024  # Largest image file accepted (after base64 decoding)
+MAX_IMAGE_PIXELS = 24_000_000  # Largest width x height accepted, checked from the header
+MIN_IMAGE_SIDE = 64  # Narrower frames can't hold a face worth matching
+MAX_REQUEST_BYTES = 32 * 1024 * 1024  # Largest request body (batches, multipart forms)
+MAX_TOP_K = 10  # Upper bound for the /verify top_k candidate list
+MAX_BATCH_SIZE = 16  # Maximum images per /verify/batch request
+BATCH_WORKERS = 4  # Threads decoding/detecting batched images
+
+# Per-camera state (requests that send a device id)
+DEVICE_STATE_MAX = 256  # Cameras remembered at once (least recently seen dropped first)
+DEVICE_STATE_TTL = 30  # Seconds before a camera's remembered state is forgotten
+ROI_TRACKING = True  # Search around each camera's last face box before the full frame
+ROI_MARGIN = 1.0  # Search region = last box grown by this fraction of its size per side
+FRAME_GATING = True  # Skip detection when a frame matches the camera's last empty frame
+FRAME_CHANGE_THRESHOLD = 8.0  # Abs difference (0-255) of any 32x24 thumbnail cell counted as a change
+
+# Face quality gate (unusable faces get a "Retry" answer instead of a match)
+QUALITY_GATE = True  # Check size, sharpness and exposure before encoding
+QUALITY_MIN_FACE_SIZE = 60  # Smallest face box side in pixels
+QUALITY_MIN_SHARPNESS = 25.0  # Laplacian variance of the face resized to 96x96
+QUALITY_BRIGHTNESS = (40, 220)  # Acceptable mean face luminance (0-255)
+QUALITY_MAX_CLIPPED = 0.4  # Max fraction of face pixels crushed black or blown out
+
+# Result cache for byte-identical /verify frames (retries, static scenes)
+RESULT_CACHE = True  # Answer repeated frames from the cache (still logged)
+RESULT_CACHE_SIZE = 512  # Cached decisions kept at once (least recent dropped first)
+RESULT_CACHE_TTL = 10  # Seconds a cached decision stays valid
+
+# Multi-core exact search
+SEARCH_SHARDS = 1  # Gallery shards scanned in parallel (1 = single-threaded scan)
+SEARCH_WORKERS = None  # Worker threads (None = one per shard)
+SHARD_MIN_ROWS = 20000  # Smaller galleries are scanned on the request thread
+
+# Multiple templates per person
+PERSON_MATCHING = "max"  # "max" = best template per person, "centroid" = mean template
+MAX_TEMPLATES_PER_PERSON = 5  # Extra enrollments are compacted to this many
+
+# Approximate nearest-neighbour search (large galleries)
+ANN_INDEX = None  # None = exact scan, "ivf" = inverted-file index, "pca" = PCA cascade
+ANN_MIN_FACES = 5000  # Below this gallery size the exact scan is used
+IVF_NLIST = None  # Coarse cells (None = ~4 * sqrt(gallery size))
+IVF_NPROBE = 8  # Cells scanned per query (higher = better recall, slower)
+PCA_DIMS = 32  # Dimensions of the coarse PCA stage
+PCA_SHORTLIST = 200  # Rows rescored at full precision
+PCA_REFIT_FRACTION = 0.2  # Refit the projection after this fraction of rows changed
+
+# Gallery storage
+GALLERY_STORAGE = "float32"  # "float32", "pq" (product-quantized uint8 codes),
+                             # or "mmap" (on-disk rows, chunked exact scan)
+PQ_SUBSPACES = 16  # Bytes per stored template in PQ mode (must divide 128)
+PQ_MIN_TRAIN = 1024  # Templates needed before the PQ codebooks are trained
+SCAN_CHUNK_ROWS = 65536  # Rows read per block in "mmap" mode (bounds scan memory)
+TOMBSTONE_COMPACT_RATIO = 0.2  # Compact in the background once this fraction of rows is deleted
 
 # File paths
 FACES_FILE = "registered_faces.json"
 LOGS_FILE = "access_logs.json"
+PQ_CODEBOOK_FILE = "pq_codebooks.npz"
+MMAP_GALLERY_FILE = "gallery_templates.npy"  # Exact templates in "mmap" and "pq" modes
+DELETED_FACES_FILE = "deleted_faces.log"  # Deletions not yet compacted into FACES_FILE
 
 # Access log settings
 MAX_LOGS = 100  # Maximum logs to keep
@@ -3,91 +3,537 @@
 
 import json
 import os
+import threading
 import numpy as np
 from datetime import datetime
-from config import FACES_FILE, LOGS_FILE, MAX_LOGS
+from config import (
+    FACES_FILE, LOGS_FILE, MAX_LOGS,
+    ANN_INDEX, ANN_MIN_FACES, IVF_NLIST, IVF_NPROBE,
+    PCA_DIMS, PCA_SHORTLIST, PCA_REFIT_FRACTION,
+    PERSON_MATCHING, MAX_TEMPLATES_PER_PERSON,
+    GALLERY_STORAGE, PQ_SUBSPACES, PQ_MIN_TRAIN, PQ_CODEBOOK_FILE,
+    MMAP_GALLERY_FILE, SCAN_CHUNK_ROWS,
+    TOMBSTONE_COMPACT_RATIO, DELETED_FACES_FILE
+)
+from gallery import Gallery, PQGallery, MemmapGallery, representative_templates, row_file_generations
+from ann_index import IVFIndex
+from pca_cascade import PCACascade
+from pq import ProductQuantizer, pack_codes, unpack_codes
 
 # In-memory storage
-known_faces = {}  # {id: {"name": str, "encoding": list}}
+known_faces = {}  # {id: {"name": str, "encodings": [list, ...]}}; without "encodings" when the
+                  # templates live in the row file ("mmap" and "pq"), where only the gallery holds them
+gallery = Gallery()  # One row per template, mirrors known_faces
+centroids = Gallery()  # One row per person (mean of their templates)
+quantizer = None  # ProductQuantizer once PQ storage is active
+row_file = MMAP_GALLERY_FILE  # Current generation of the row file, as named in the faces file
 access_logs = []
 
+# Faces file entry naming the row file once a rewrite has moved it to a new generation
+_ROW_FILE_KEY = "__row_file__"
+
+# Writers and the background compaction take turns on the galleries
+_write_lock = threading.RLock()
+_compaction = None  # Compaction thread while one is running (joined by finish_compaction)
+
+# Readers never touch the galleries above, only the last published snapshot
+snapshot = Gallery()  # Frozen copy of matching_gallery()
+gallery_version = 0  # Bumped on every publish
+
 
 def load_faces():
     """Load registered faces from JSON file"""
-    global known_faces
-    if os.path.exists(FACES_FILE):
-        with open(FACES_FILE, 'r') as f:
-            known_faces = json.load(f)
-        print(f"Loaded {len(known_faces)} registered faces")
+    global known_faces, quantizer, row_file, gallery, centroids
+    with _write_lock:
+        if os.path.exists(FACES_FILE):
+            with open(FACES_FILE, 'r') as f:
+                known_faces = json.load(f)
+            print(f"Loaded {len(known_faces)} registered faces")
+        else:
+            known_faces = {}
+            print("No existing faces found, starting fresh")
+        row_file = known_faces.pop(_ROW_FILE_KEY, MMAP_GALLERY_FILE)
+        gallery, centroids = Gallery(), Gallery()
+        
+        # Older files stored a single "encoding" per entry
+        for data in known_faces.values():
+            if "encoding" in data:
+                data["encodings"] = [data.pop("encoding")]
+        
+        # Deletions made since the file was last rewritten
+        for face_id in _load_deleted():
+            known_faces.pop(face_id, None)
+        
+        quantizer = None
+        if GALLERY_STORAGE == "pq" and os.path.exists(PQ_CODEBOOK_FILE):
+            quantizer = ProductQuantizer.load(PQ_CODEBOOK_FILE)
+        
+        _decode_code_only_templates()
+        if quantizer is None:
+            # Codes from an earlier "pq" run go stale once templates change
+            for data in known_faces.values():
+                data.pop("codes", None)
+        
+        # Templates an earlier "mmap" or "pq" run moved into the row file
+        if GALLERY_STORAGE != "mmap" and quantizer is None:
+            _restore_mapped_templates()
+        
+        _build_galleries()
+        maybe_enable_pq()
+        if uses_row_file():
+            _remove_stale_row_files()
+        publish()
+
+
+def _build_galleries():
+    """Rebuild the template and centroid galleries from known_faces"""
+    global gallery, centroids
+    if quantizer is not None:
+        # Exact templates go to the row file, the codes are what gets scanned
+        gallery = _open_row_gallery(PQGallery, quantizer=quantizer)
+        _move_into_row_file()
+    elif GALLERY_STORAGE == "mmap":
+        gallery = _open_row_gallery(MemmapGallery)
+        _move_into_row_file()
+    else:
+        gallery = Gallery.from_faces(known_faces)
+    
+    # Centroids are only needed when matching against them
+    person_centroids = {}
+    if PERSON_MATCHING == "centroid":
+        person_centroids = {
+            person_id: {"name": data["name"], "encodings": [person_centroid(person_id)]}
+            for person_id, data in known_faces.items() if template_count(person_id)
+        }
+    if quantizer is not None:
+        centroids = PQGallery.from_faces(person_centroids, quantizer=quantizer)
+    else:
+        centroids = Gallery.from_faces(person_centroids)
+    update_index()
+
+
+def _open_row_gallery(cls, **kwargs):
+    """
+    Open (or create) the row file as a `cls` gallery
+    
+    The rows, norms and codes read from the faces file go to the gallery
+    and are dropped from known_faces.
+    """
+    if os.path.exists(row_file):
+        rows = cls.open(row_file, known_faces, chunk_rows=SCAN_CHUNK_ROWS, **kwargs)
+    elif any(data.get("rows") for data in known_faces.values()):
+        raise RuntimeError(f"{FACES_FILE} stores templates in {row_file}, which is missing")
     else:
-        known_faces = {}
-        print("No existing faces found, starting fresh")
+        rows = cls(path=row_file, chunk_rows=SCAN_CHUNK_ROWS, **kwargs)
+    for data in known_faces.values():
+        for field in ("rows", "norms", "codes"):
+            data.pop(field, None)
+    return rows
+
+
+def _move_into_row_file():
+    """Move float encodings from known_faces into the row file gallery"""
+    moved = [person_id for person_id, data in known_faces.items() if "encodings" in data]
+    for person_id in moved:
+        data = known_faces[person_id]
+        encodings = data.pop("encodings")
+        if encodings:
+            gallery.add(person_id, data["name"], encodings)
+    if moved:
+        save_faces()
+        print(f"Moved {len(moved)} faces into {gallery.path}")
+
+
+def _remove_stale_row_files():
+    """Delete row file generations the faces file no longer points to (left by an interrupted save)"""
+    for path in row_file_generations(MMAP_GALLERY_FILE):
+        if os.path.normpath(path) == os.path.normpath(gallery.path):
+            continue
+        try:
+            os.remove(path)
+            print(f"Removed stale row file {path}")
+        except OSError as e:
+            print(f"[WARN] Could not remove stale row file {path}: {e}")
+
+
+def _restore_mapped_templates():
+    """Read templates stored as rows of the row file back into float encodings"""
+    mapped = [data for data in known_faces.values() if "rows" in data]
+    if not mapped:
+        return
+    if not os.path.exists(row_file):
+        raise RuntimeError(
+            f"{FACES_FILE} stores templates in {row_file}, which is missing "
+            f"(set GALLERY_STORAGE = \"mmap\" or restore the file)"
+        )
+    store = np.load(row_file, mmap_mode='r')
+    for data in mapped:
+        norms = np.asarray(data.pop("norms"), dtype=np.float32)
+        data["encodings"] = (store[data.pop("rows")] * norms[:, None]).tolist()
+    del store
+    save_faces()
+    print(f"Moved {len(mapped)} faces out of {row_file}")
+
+
+def _decode_code_only_templates():
+    """
+    Rebuild float encodings for entries that kept nothing but PQ codes
+    
+    Earlier PQ runs replaced the templates with their codes. The codes are
+    decoded with the saved codebooks, so these templates are approximate.
+    """
+    code_only = [data for data in known_faces.values() if "codes" in data and "rows" not in data]
+    if not code_only:
+        return
+    if not os.path.exists(PQ_CODEBOOK_FILE):
+        raise RuntimeError(f"{FACES_FILE} stores PQ codes but {PQ_CODEBOOK_FILE} is missing")
+    codebooks = quantizer or ProductQuantizer.load(PQ_CODEBOOK_FILE)
+    for data in code_only:
+        codes = [unpack_codes(c) for c in data.pop("codes")]
+        norms = np.asarray(data.pop("norms"), dtype=np.float32)
+        data["encodings"] = (codebooks.decode(np.stack(codes)) * norms[:, None]).tolist() if codes else []
+    save_faces()
+    print(f"[WARN] Rebuilt {len(code_only)} faces from their PQ codes (approximate templates)")
+
+
+def uses_row_file():
+    """True when the templates live in the row file ("mmap", or "pq" once trained)"""
+    return GALLERY_STORAGE == "mmap" or quantizer is not None
 
 
 def save_faces():
     """Save registered faces to JSON file"""
-    with open(FACES_FILE, 'w') as f:
-        json.dump(known_faces, f, indent=2)
+    global row_file
+    gallery.flush()
+    if gallery.path is not None:
+        row_file = gallery.path
+    # Swap in a complete file, so a crash never leaves a truncated one
+    temp_path = FACES_FILE + ".tmp"
+    _write_faces(temp_path)
+    os.replace(temp_path, FACES_FILE)
+    # The rewritten file already leaves out deleted people
+    if os.path.exists(DELETED_FACES_FILE):
+        os.remove(DELETED_FACES_FILE)
+    # Earlier row files are unreferenced now that the faces file is written
+    gallery.discard_retired()
 
 
-def add_face(name, encoding):
+def _write_faces(path):
     """
-    Add a new face to the database
+    Write known_faces as JSON, one person per line
+    
+    Templates kept in the row file are written as their rows, norms and
+    (with PQ) codes, read from the gallery as each person is written, so
+    no second copy of the faces is built in memory. Entries still in the
+    form they were loaded in (while load_faces converts them) are written
+    as they are. Once rewrites have moved the row file to a new
+    generation, its name is written first, under _ROW_FILE_KEY.
+    """
+    entries = list(known_faces.items())
+    if row_file != MMAP_GALLERY_FILE:
+        entries.insert(0, (_ROW_FILE_KEY, row_file))
+    with open(path, 'w') as f:
+        f.write("{")
+        for count, (person_id, data) in enumerate(entries):
+            if person_id != _ROW_FILE_KEY and "encodings" not in data and "rows" not in data:
+                rows = gallery.rows_of(person_id)
+                data = dict(data, rows=rows, norms=gallery.norms[rows].tolist())
+                if quantizer is not None:
+                    data["codes"] = [pack_codes(code) for code in gallery.codes[rows]]
+            f.write(f"{',' if count else ''}\n  {json.dumps(person_id)}: {json.dumps(data)}")
+        f.write("\n}\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _load_deleted():
+    """Ids in the deletion journal (people deleted since the last save_faces)"""
+    if not os.path.exists(DELETED_FACES_FILE):
+        return []
+    with open(DELETED_FACES_FILE, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def template_count(person_id):
+    """Number of templates a person has"""
+    data = known_faces.get(person_id, {})
+    if "encodings" in data:
+        return len(data["encodings"])
+    return gallery.template_count(person_id)
+
+
+def template_encodings(person_id):
+    """A person's templates as a (T, D) float32 array (exact copies from the row file)"""
+    data = known_faces[person_id]
+    if "encodings" in data:
+        return np.asarray(data["encodings"], dtype=np.float32).reshape(-1, gallery.dim)
+    rows = gallery.rows_of(person_id)
+    return gallery.unit_vectors(rows) * gallery.norms[rows][:, None]
+
+
+def _set_templates(person_id, encodings):
+    """Replace a person's templates and push them into the template and centroid galleries"""
+    data = known_faces[person_id]
+    if "encodings" in data:
+        data["encodings"] = [e.tolist() if isinstance(e, np.ndarray) else e for e in encodings]
+    gallery.add(person_id, data["name"], encodings)
+    if PERSON_MATCHING == "centroid":
+        centroids.add(person_id, data["name"], person_centroid(person_id))
+    update_index()
+
+
+def maybe_enable_pq():
+    """
+    Switch to product-quantized storage once enough templates exist to train
+    
+    Trains the codebooks on the current gallery, moves the float templates
+    into the row file (kept as the exact copy, so switching back to
+    "float32" or "mmap" loses nothing), adds their uint8 codes and
+    rewrites the faces file.
+    """
+    global quantizer
+    if GALLERY_STORAGE != "pq" or quantizer is not None or len(gallery) < PQ_MIN_TRAIN:
+        return False
+    quantizer = ProductQuantizer(dim=gallery.dim, subspaces=PQ_SUBSPACES)
+    quantizer.train(gallery.matrix)
+    quantizer.save(PQ_CODEBOOK_FILE)
+    _build_galleries()
+    print(f"Converted {len(gallery)} templates to PQ codes ({PQ_SUBSPACES} bytes each, exact copies in {gallery.path})")
+    return True
+
+
+def person_centroid(person_id):
+    """Mean of a person's template encodings"""
+    return np.mean(template_encodings(person_id), axis=0)
+
+
+def matching_gallery():
+    """Gallery searched by /verify: templates or per-person centroids"""
+    return centroids if PERSON_MATCHING == "centroid" else gallery
+
+
+def create_index():
+    """New instance of the configured search index"""
+    if ANN_INDEX == "ivf":
+        return IVFIndex(nlist=IVF_NLIST, nprobe=IVF_NPROBE)
+    if ANN_INDEX == "pca":
+        return PCACascade(dims=PCA_DIMS, shortlist=PCA_SHORTLIST, refit_fraction=PCA_REFIT_FRACTION)
+    return None
+
+
+def update_index():
+    """Build or retrain the configured search index once the gallery is large enough"""
+    target = matching_gallery()
+    if ANN_INDEX not in ("ivf", "pca") or isinstance(target, MemmapGallery):
+        return
+    index = target.index
+    if len(target) < ANN_MIN_FACES:
+        if index is not None:
+            target.attach_index(None)
+        return
+    if index is None or index.needs_retrain():
+        target.attach_index(create_index())
+        print(f"Built {ANN_INDEX} index over {len(target)} faces")
+
+
+def publish():
+    """
+    Publish a new immutable snapshot of the matching gallery
+    
+    Writers call this (under _write_lock) after changing the galleries.
+    Rebinding the module global is atomic, so readers take no lock: each
+    request matches against whichever snapshot it grabbed, while newer
+    ones are published alongside.
+    """
+    global snapshot, gallery_version
+    frozen = matching_gallery().snapshot()
+    gallery_version += 1
+    frozen.version = gallery_version
+    snapshot = frozen
+
+
+def add_face(name, encoding, person_id=None):
+    """
+    Add a face to the database
+    
+    Passing the person_id of a registered person adds another template to
+    that person. Without one a new person is created, even if the name is
+    already registered (two people can share a name).
     
     Args:
         name: Person's name
         encoding: Face encoding (numpy array or list)
+        person_id: Optional existing person to add the template to
         
     Returns:
-        Face ID
+        Face ID of the person
+    
+    Raises:
+        ValueError: `person_id` isn't a registered person
     """
-    # Generate unique ID
-    face_id = str(len(known_faces) + 1)
-    while face_id in known_faces:
-        face_id = str(int(face_id) + 1)
+    with _write_lock:
+        if person_id is not None and person_id not in known_faces:
+            raise ValueError(f"Unknown person_id {person_id}")
+        
+        if person_id is None:
+            # Generate unique ID
+            person_id = str(len(known_faces) + 1)
+            while person_id in known_faces:
+                person_id = str(int(person_id) + 1)
+            known_faces[person_id] = {
+                "name": name,
+                "registered_at": datetime.now().isoformat()
+            }
+            if not uses_row_file():
+                # Without a row file the faces file holds the encodings
+                known_faces[person_id]["encodings"] = []
+        
+        data = known_faces[person_id]
+        if isinstance(encoding, np.ndarray):
+            encoding = encoding.tolist()
+        templates = list(data["encodings"]) if "encodings" in data else list(template_encodings(person_id))
+        templates.append(encoding)
+        if len(templates) > MAX_TEMPLATES_PER_PERSON:
+            keep = representative_templates(templates, MAX_TEMPLATES_PER_PERSON)
+            templates = [templates[i] for i in keep]
+        _set_templates(person_id, templates)
+        if not maybe_enable_pq():
+            save_faces()
+        publish()
     
-    # Convert numpy array to list if needed
-    if isinstance(encoding, np.ndarray):
-        encoding = encoding.tolist()
+    maybe_compact()
     
-    known_faces[face_id] = {
-        "name": name,
-        "encoding": encoding,
-        "registered_at": datetime.now().isoformat()
-    }
-    save_faces()
+    print(f"Added face: {data['name']} (ID: {person_id}, templates: {len(templates)})")
+    return person_id
+
+
+def compact_faces(max_templates=None):
+    """
+    Reduce every person's templates to a small representative set
     
-    print(f"Added face: {name} (ID: {face_id})")
-    return face_id
+    Args:
+        max_templates: Templates to keep per person (default MAX_TEMPLATES_PER_PERSON)
+        
+    Returns:
+        Number of templates removed
+    """
+    if max_templates is None:
+        max_templates = MAX_TEMPLATES_PER_PERSON
+    removed = 0
+    with _write_lock:
+        for person_id in known_faces:
+            templates = template_encodings(person_id)
+            if len(templates) <= max_templates:
+                continue
+            keep = representative_templates(templates, max_templates)
+            removed += len(templates) - len(keep)
+            if "encodings" in known_faces[person_id]:
+                # Keep the stored values as they are, not float32 copies
+                _set_templates(person_id, [known_faces[person_id]["encodings"][i] for i in keep])
+            else:
+                _set_templates(person_id, templates[keep])
+        if removed:
+            save_faces()
+            publish()
+    maybe_compact()
+    return removed
 
 
 def delete_face(face_id):
-    """Delete a face from the database"""
-    if face_id in known_faces:
-        name = known_faces[face_id]["name"]
-        del known_faces[face_id]
+    """
+    Delete a person and all their templates from the database
+    
+    The person's gallery rows are tombstoned, so matching ignores them
+    immediately, and the id is appended to DELETED_FACES_FILE instead of
+    rewriting the faces file. The galleries and files are compacted in
+    the background once TOMBSTONE_COMPACT_RATIO of the rows are dead.
+    """
+    with _write_lock:
+        if face_id not in known_faces:
+            return False, None
+        name = known_faces.pop(face_id)["name"]
+        gallery.remove(face_id)
+        centroids.remove(face_id)
+        update_index()
+        with open(DELETED_FACES_FILE, 'a') as f:
+            f.write(f"{face_id}\n")
+        publish()
+    maybe_compact()
+    return True, name
+
+
+def maybe_compact():
+    """
+    Start a background compaction once enough gallery rows are tombstones
+    
+    The thread is not a daemon: interpreter exit waits for it (and
+    finish_compaction joins it explicitly), so the row file and faces
+    file are never abandoned half rewritten.
+    """
+    global _compaction
+    if max(gallery.dead_ratio, centroids.dead_ratio) < TOMBSTONE_COMPACT_RATIO:
+        return False
+    if _compaction is not None and _compaction.is_alive():
+        return False
+    _compaction = threading.Thread(target=compact_gallery, name="gallery-compaction")
+    _compaction.start()
+    return True
+
+
+def finish_compaction():
+    """Wait for a running background compaction to finish (call before shutting down)"""
+    if _compaction is not None:
+        _compaction.join()
+
+
+def compact_gallery():
+    """
+    Drop tombstoned rows from the galleries and rewrite the stores on disk
+    
+    Returns:
+        Number of template rows dropped
+    """
+    with _write_lock:
+        dropped = gallery.compact()
+        centroids.compact()
+        update_index()
         save_faces()
-        return True, name
-    return False, None
+        publish()
+    print(f"Compacted gallery: dropped {dropped} deleted templates")
+    return dropped
 
 
 def get_all_faces():
     """Get list of all registered faces (without encodings)"""
+    # list() copies the items in one step, so concurrent writers can't
+    # change the dict under the iteration
     return [
         {
             "id": face_id,
             "name": data["name"],
+            "templates": template_count(face_id),
             "registered_at": data.get("registered_at", "Unknown")
         }
-        for face_id, data in known_faces.items()
+        for face_id, data in list(known_faces.items())
     ]
 
 
 def get_known_encodings():
-    """Get all face encodings and names for matching"""
-    encodings = [np.array(f["encoding"]) for f in known_faces.values()]
-    names = [f["name"] for f in known_faces.values()]
-    return encodings, names
+    """
+    Get the current gallery snapshot and its aligned names for matching
+
+    The gallery is maintained incrementally by add_face/delete_face, so no
+    per-request rebuild from the JSON lists is needed. Depending on
+    PERSON_MATCHING this is the per-template gallery (scored by each
+    person's best template) or the per-person centroid gallery. The
+    snapshot is immutable, so it stays consistent for the whole request
+    even while faces are being enrolled or deleted.
+
+    Returns:
+        Tuple of (Gallery snapshot, names array aligned with gallery rows)
+    """
+    current = snapshot
+    return current, current.names
 
 
 def load_logs():
@@ -104,8 +550,8 @@ def save_logs():
         json.dump(access_logs[-MAX_LOGS:], f, indent=2)
 
 
-def log_access(authorized, name, confidence=0):
-    """Log an access attempt"""
+def _append_log(authorized, name, confidence=0):
+    """Append one access entry to the in-memory log"""
     entry = {
         "timestamp": datetime.now().isoformat(),
         "authorized": authorized,
@@ -113,12 +559,29 @@ def log_access(authorized, name, confidence=0):
         "confidence": round(confidence, 3)
     }
     access_logs.append(entry)
-    save_logs()
     
     status = "GRANTED" if authorized else "DENIED"
     print(f"[LOG] {entry['timestamp']} - {name}: {status}")
 
 
+def log_access(authorized, name, confidence=0):
+    """Log an access attempt"""
+    _append_log(authorized, name, confidence)
+    save_logs()
+
+
+def log_accesses(attempts):
+    """
+    Log several access attempts with a single write to disk
+    
+    Args:
+        attempts: Iterable of (authorized, name, confidence) tuples
+    """
+    for authorized, name, confidence in attempts:
+        _append_log(authorized, name, confidence)
+    save_logs()
+
+
 def get_logs(limit=50):
     """Get recent access logs"""
     return access_logs[-limit:][::-1]  # Newest first
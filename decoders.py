@@ -0,0 +1,121 @@
+# Image Decoders
+# Backends turning uploaded image bytes into the arrays detection and encoding use
+
+import io
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def pil_decode(data, mode, reduce=1):
+    """
+    Decode with Pillow
+
+    JPEGs are scaled inside the DCT via draft mode (and only the Y channel
+    is decoded for 'L'); other formats, and whatever factor draft mode
+    couldn't apply, are reduced after decoding. Sizes match opencv_decode.
+
+    Args:
+        data: Encoded image bytes
+        mode: 'L' for an (H, W) luminance plane or 'RGB' for (H, W, 3)
+        reduce: 1, 2, 4 or 8
+
+    Returns:
+        uint8 numpy array
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        scaled = 1
+        if image.format == 'JPEG':
+            # libjpeg's scaled IDCT rounds sizes up
+            target = (-(-width // reduce), -(-height // reduce))
+            drafted = image.draft(mode, target)
+            if drafted is not None:
+                # Draft settles for a smaller factor when a side isn't a
+                # multiple of the requested one (2 for 3001x2001 at 1/4)
+                scaled = round(width / drafted[1][2])
+        else:
+            # OpenCV resizes other formats down to whole pixels
+            target = (width // reduce, height // reduce)
+        image = image.convert(mode)
+        if scaled < reduce:
+            # The rest of the factor, and all of it for formats without DCT scaling
+            image = image.reduce(reduce // scaled)
+        if image.size != target:
+            # Partial blocks at the edges, which OpenCV drops
+            image = image.crop((0, 0) + target)
+        return np.asarray(image)
+
+
+if cv2 is not None:
+    # imdecode flags per (mode, reduce); the REDUCED_* flags use libjpeg's
+    # scaled IDCT for JPEG and resize after decoding for other formats
+    OPENCV_FLAGS = {
+        ('L', 1): cv2.IMREAD_GRAYSCALE,
+        ('L', 2): cv2.IMREAD_REDUCED_GRAYSCALE_2,
+        ('L', 4): cv2.IMREAD_REDUCED_GRAYSCALE_4,
+        ('L', 8): cv2.IMREAD_REDUCED_GRAYSCALE_8,
+        ('RGB', 1): cv2.IMREAD_COLOR,
+        ('RGB', 2): cv2.IMREAD_REDUCED_COLOR_2,
+        ('RGB', 4): cv2.IMREAD_REDUCED_COLOR_4,
+        ('RGB', 8): cv2.IMREAD_REDUCED_COLOR_8,
+    }
+    # OpenCV >= 4.10 can emit RGB directly instead of BGR
+    OPENCV_RGB_ORDER = getattr(cv2, 'IMREAD_COLOR_RGB', None)
+
+
+def opencv_decode(data, mode, reduce=1):
+    """
+    Decode with cv2.imdecode straight from the request bytes
+
+    The bytes are wrapped in a NumPy view (no BytesIO, no PIL image) and
+    decoded into the final layout: an (H, W) plane for 'L' and (H, W, 3)
+    RGB for 'RGB'. Same arguments as pil_decode.
+    """
+    # EXIF orientation is ignored, as with Pillow, so both backends agree
+    # with the header size
+    flags = OPENCV_FLAGS[(mode, reduce)] | cv2.IMREAD_IGNORE_ORIENTATION
+    rgb_order = mode == 'RGB' and OPENCV_RGB_ORDER is not None
+    if rgb_order:
+        flags = (flags & ~cv2.IMREAD_COLOR) | OPENCV_RGB_ORDER
+    array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flags)
+    if array is None:
+        raise ValueError("cannot decode image data")
+    if mode == 'RGB' and not rgb_order:
+        cv2.cvtColor(array, cv2.COLOR_BGR2RGB, dst=array)
+    return array
+
+
+DECODERS = {
+    "opencv": opencv_decode,
+    "pil": pil_decode,
+}
+
+# Order tried by "auto"
+DECODER_PREFERENCE = ("opencv", "pil")
+
+
+def decoder_available(name):
+    return name == "pil" or (name == "opencv" and cv2 is not None)
+
+
+def select_decoder(name="auto"):
+    """
+    The configured decode backend as (name, function)
+
+    "auto" picks the first available of DECODER_PREFERENCE; a requested
+    backend that isn't available falls back to "auto".
+    """
+    if name not in DECODERS and name != "auto":
+        raise ValueError(f"Unknown image decoder {name!r} (choose from {', '.join(DECODERS)})")
+    if name != "auto":
+        if decoder_available(name):
+            return name, DECODERS[name]
+        print(f"[WARN] Image decoder '{name}' not available, choosing automatically")
+    for candidate in DECODER_PREFERENCE:
+        if decoder_available(candidate):
+            return candidate, DECODERS[candidate]
@@ -0,0 +1,277 @@
+# Face Detectors
+# Registry of pre-loaded face detection backends reused across requests
+
+import os
+import queue
+import threading
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+def cascade_dirs():
+    """Folders searched for OpenCV cascade files"""
+    dirs = []
+    if cv2 is not None and hasattr(cv2, 'data'):
+        dirs.append(cv2.data.haarcascades)
+        # Some OpenCV builds ship lbpcascades/ next to haarcascades/
+        dirs.append(os.path.join(os.path.dirname(cv2.data.haarcascades.rstrip(os.sep)), 'lbpcascades'))
+    dirs.append('')
+    return dirs
+
+
+def downscale(image_array, max_side):
+    """
+    Shrink an image so that its longer side is at most `max_side`
+
+    Args:
+        image_array: numpy image (H, W) or (H, W, C)
+        max_side: Largest allowed side in pixels (None/0 = no limit)
+
+    Returns:
+        Tuple of (image, scale) where scale is new size / original size
+        (1.0 and the original array when no resize was needed)
+    """
+    h, w = image_array.shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return image_array, 1.0
+    scale = max_side / max(h, w)
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    if cv2 is not None:
+        small = cv2.resize(image_array, size, interpolation=cv2.INTER_AREA)
+    else:
+        small = np.asarray(Image.fromarray(image_array).resize(size, Image.BILINEAR))
+    return small, scale
+
+
+def upscale_locations(locations, scale, shape):
+    """
+    Map (top, right, bottom, left) boxes found on a downscaled copy back
+    to the original frame
+
+    Args:
+        locations: Boxes on the image returned by `downscale`
+        scale: The scale `downscale` returned
+        shape: Shape of the original image
+
+    Returns:
+        List of boxes in original pixel coordinates, clipped to the frame
+    """
+    if scale == 1.0:
+        return list(locations)
+    h, w = shape[:2]
+    return [
+        (
+            max(0, int(top / scale)),
+            min(w, int(round(right / scale))),
+            min(h, int(round(bottom / scale))),
+            max(0, int(left / scale)),
+        )
+        for top, right, bottom, left in locations
+    ]
+
+
+class CascadeDetector:
+    """
+    OpenCV cascade detector backed by a pool of pre-loaded classifiers
+
+    Parsing the cascade XML is the expensive part, so `warm` parses
+    `pool_size` classifiers up front into a queue. Every detect call
+    checks one out and puts it back afterwards, whichever thread serves
+    the request (the threaded dev server starts a new thread per request,
+    so per-thread classifiers would be parsed on every request). A
+    classifier is only used by one thread at a time, because
+    detectMultiScale keeps per-call state inside it; when all of them are
+    busy, callers wait for the next one returned.
+    """
+
+    name = None
+    filename = None
+
+    def __init__(self, path, pool_size=4):
+        self.path = path
+        self.pool_size = max(1, pool_size)
+        self._pool = queue.Queue()
+        self._loaded = 0  # Classifiers parsed so far (in the pool or checked out)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def find(cls):
+        """Path of this backend's cascade file, or None if it isn't installed"""
+        if cv2 is None:
+            return None
+        for folder in cascade_dirs():
+            path = os.path.join(folder, cls.filename)
+            if os.path.exists(path):
+                return path
+        return None
+
+    @classmethod
+    def create(cls, pool_size=4):
+        path = cls.find()
+        return cls(path, pool_size) if path else None
+
+    def describe(self):
+        return f"{self.name} ({os.path.basename(self.path)}, pool of {self.pool_size})"
+
+    def _load(self):
+        """Parse one more classifier if the pool isn't full yet, else return None"""
+        with self._lock:
+            if self._loaded >= self.pool_size:
+                return None
+            self._loaded += 1
+        classifier = cv2.CascadeClassifier(self.path)
+        if classifier.empty():
+            with self._lock:
+                self._loaded -= 1
+            raise RuntimeError(f"Could not load cascade {self.path}")
+        return classifier
+
+    def _checkout(self):
+        """An idle classifier, parsing one if the pool isn't full (waits when all are busy)"""
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        classifier = self._load()
+        return classifier if classifier is not None else self._pool.get()
+
+    def detect(self, image_array):
+        """
+        Args:
+            image_array: RGB numpy array or (H, W) luminance plane
+
+        Returns:
+            List of face locations as (top, right, bottom, left)
+        """
+        gray = image_array
+        if image_array.ndim == 3:
+            gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+        classifier = self._checkout()
+        try:
+            faces = classifier.detectMultiScale(gray, 1.1, 4, minSize=(30, 30))
+        finally:
+            self._pool.put(classifier)
+
+        # Convert from (x, y, w, h) to (top, right, bottom, left)
+        return [(y, x + w, y + h, x) for (x, y, w, h) in faces]
+
+    def warm(self):
+        """Parse the whole pool and run every classifier once"""
+        blank = np.zeros((64, 64), dtype=np.uint8)
+        while True:
+            classifier = self._load()
+            if classifier is None:
+                break
+            classifier.detectMultiScale(blank, 1.1, 4, minSize=(30, 30))
+            self._pool.put(classifier)
+
+
+class HaarDetector(CascadeDetector):
+    """Viola-Jones Haar frontal-face cascade"""
+
+    name = "haar"
+    filename = "haarcascade_frontalface_default.xml"
+
+
+class LBPDetector(CascadeDetector):
+    """Local binary pattern frontal-face cascade (faster, slightly less accurate)"""
+
+    name = "lbp"
+    filename = "lbpcascade_frontalface_improved.xml"
+
+
+class HOGDetector:
+    """face_recognition's HOG detector (dlib), used when face_recognition is installed"""
+
+    name = "hog"
+
+    def __init__(self, face_recognition):
+        self.face_recognition = face_recognition
+
+    @classmethod
+    def create(cls, face_recognition=None):
+        return cls(face_recognition) if face_recognition is not None else None
+
+    def describe(self):
+        return "hog (face_recognition)"
+
+    def detect(self, image_array):
+        return self.face_recognition.face_locations(image_array)
+
+    def warm(self):
+        self.detect(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+class MockDetector:
+    """Demo mode: always reports one face in the centre of the frame"""
+
+    name = "mock"
+
+    @classmethod
+    def create(cls):
+        return cls()
+
+    def describe(self):
+        return "mock (centre of frame)"
+
+    def detect(self, image_array):
+        h, w = image_array.shape[:2]
+        return [(h // 4, 3 * w // 4, 3 * h // 4, w // 4)]
+
+    def warm(self):
+        pass
+
+
+DETECTORS = {
+    "hog": HOGDetector,
+    "haar": HaarDetector,
+    "lbp": LBPDetector,
+    "mock": MockDetector,
+}
+
+# Order tried by "auto"
+DETECTOR_PREFERENCE = ("hog", "haar", "lbp", "mock")
+
+
+def create_detector(name, face_recognition=None, pool_size=4):
+    """
+    Instantiate the backend called `name`
+
+    Args:
+        name: Key of DETECTORS
+        face_recognition: The imported face_recognition module, if available
+        pool_size: Classifiers kept by cascade backends
+
+    Returns:
+        Detector instance, or None if the backend isn't available here
+    """
+    backend = DETECTORS.get(name)
+    if backend is None:
+        raise ValueError(f"Unknown face detector {name!r} (choose from {', '.join(DETECTORS)})")
+    if backend is HOGDetector:
+        return backend.create(face_recognition)
+    if issubclass(backend, CascadeDetector):
+        return backend.create(pool_size)
+    return backend.create()
+
+
+def select_detector(name="auto", face_recognition=None, pool_size=4):
+    """
+    The configured backend, or the first available one for "auto"
+
+    A requested backend that isn't available falls back to "auto".
+    """
+    if name != "auto":
+        detector = create_detector(name, face_recognition, pool_size)
+        if detector is not None:
+            return detector
+        print(f"[WARN] Face detector '{name}' not available, choosing automatically")
+    for candidate in DETECTOR_PREFERENCE:
+        detector = create_detector(candidate, face_recognition, pool_size)
+        if detector is not None:
+            return detector
@@ -0,0 +1,52 @@
+# Per-Device State
+# Small bounded, expiring store keyed by camera identity
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class DeviceCache:
+    """
+    Per-device values kept in LRU order with a time-to-live
+
+    At most `max_devices` devices are remembered (least recently updated
+    are dropped first) and a value older than `ttl` seconds is treated as
+    missing, so state for cameras that went quiet doesn't accumulate.
+    """
+
+    def __init__(self, max_devices=256, ttl=30.0):
+        self.max_devices = max_devices
+        self.ttl = ttl
+        self._values = OrderedDict()  # {device_id: (value, updated_at)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def get(self, device_id):
+        """Value stored for `device_id`, or None if missing or expired"""
+        with self._lock:
+            entry = self._values.get(device_id)
+            if entry is None:
+                return None
+            value, updated_at = entry
+            if time.monotonic() - updated_at > self.ttl:
+                del self._values[device_id]
+                return None
+            return value
+
+    def put(self, device_id, value):
+        with self._lock:
+            self._values[device_id] = (value, time.monotonic())
+            self._values.move_to_end(device_id)
+            while len(self._values) > self.max_devices:
+                self._values.popitem(last=False)
+
+    def pop(self, device_id):
+        with self._lock:
+            self._values.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
@@ -0,0 +1,72 @@
+# Face Quality Gate
+# Cheap checks on a detected face before spending time encoding and matching it
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+SHARPNESS_SIZE = 96  # Crops are resized to this square before measuring blur
+
+# Reasons returned by check_face_quality
+FACE_TOO_SMALL = "Face too small"
+FACE_BLURRED = "Face blurred"
+FACE_TOO_DARK = "Face too dark"
+FACE_TOO_BRIGHT = "Face too bright"
+QUALITY_FAILURES = (FACE_TOO_SMALL, FACE_BLURRED, FACE_TOO_DARK, FACE_TOO_BRIGHT)
+
+
+def laplacian_variance(gray):
+    """Variance of the 4-neighbour Laplacian (low = blurred)"""
+    if cv2 is not None:
+        return float(cv2.Laplacian(gray, cv2.CV_32F).var())
+    g = gray.astype(np.float32)
+    lap = g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:] - 4 * g[1:-1, 1:-1]
+    return float(lap.var())
+
+
+def check_face_quality(gray, location, min_size=60, min_sharpness=25.0,
+                       brightness=(40, 220), max_clipped=0.4):
+    """
+    Decide whether a detected face is worth encoding
+
+    Args:
+        gray: (H, W) uint8 luminance plane of the frame
+        location: Face box as (top, right, bottom, left)
+        min_size: Smallest acceptable box side in pixels
+        min_sharpness: Smallest acceptable Laplacian variance, measured on
+            the crop resized to SHARPNESS_SIZE so it doesn't depend on scale
+        brightness: (low, high) acceptable mean luminance of the crop
+        max_clipped: Largest fraction of crop pixels allowed to be crushed
+            black (< 16) or blown out (> 239)
+
+    Returns:
+        None if the face is usable, otherwise one of QUALITY_FAILURES
+    """
+    top, right, bottom, left = location
+    if min(bottom - top, right - left) < min_size:
+        return FACE_TOO_SMALL
+
+    crop = gray[max(0, top):bottom, max(0, left):right]
+    if crop.size == 0:
+        return FACE_TOO_SMALL
+
+    # Exposure from the luminance histogram
+    histogram = np.bincount(crop.ravel(), minlength=256)
+    mean = float(np.dot(histogram, np.arange(256))) / crop.size
+    if mean < brightness[0] or histogram[:16].sum() > max_clipped * crop.size:
+        return FACE_TOO_DARK
+    if mean > brightness[1] or histogram[240:].sum() > max_clipped * crop.size:
+        return FACE_TOO_BRIGHT
+
+    size = (SHARPNESS_SIZE, SHARPNESS_SIZE)
+    if cv2 is not None:
+        small = cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+    else:
+        small = np.asarray(Image.fromarray(crop).resize(size, Image.BOX))
+    if laplacian_variance(small) < min_sharpness:
+        return FACE_BLURRED
+    return None
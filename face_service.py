@@ -5,8 +5,26 @@
 import numpy as np
 import base64
 import io
-import os
 from PIL import Image
+from gallery import Gallery, MemmapGallery, normalize_rows
+from sharded_search import ShardedSearcher
+from chunked_scan import chunked_topk
+from detectors import select_detector, downscale, upscale_locations
+from decoders import select_decoder
+from ingest import InvalidUpload
+from image_header import ImageHeader, probe_header, admit
+from roi_tracker import ROITracker
+from frame_gate import FrameGate
+from face_quality import check_face_quality
+from fallback_encoder import encode_crops
+from config import (
+    SEARCH_SHARDS, SEARCH_WORKERS, SHARD_MIN_ROWS, FACE_DETECTOR, DETECTOR_POOL_SIZE,
+    DETECT_MAX_SIDE, DEVICE_STATE_MAX, DEVICE_STATE_TTL, ROI_TRACKING, ROI_MARGIN,
+    FRAME_GATING, FRAME_CHANGE_THRESHOLD,
+    QUALITY_GATE, QUALITY_MIN_FACE_SIZE, QUALITY_MIN_SHARPNESS,
+    QUALITY_BRIGHTNESS, QUALITY_MAX_CLIPPED, DECODE_MAX_SIDE, IMAGE_DECODER,
+    MAX_IMAGE_PIXELS, MIN_IMAGE_SIDE
+)
 
 # Configuration
 USE_MOCK_MODE = False  # Set to True to force mock mode
@@ -39,32 +57,141 @@ if not USE_MOCK_MODE:
 
 # Try OpenCV for face detection if face_recognition not available
 OPENCV_AVAILABLE = False
-CASCADE_PATH = None
 
 if not FACE_RECOGNITION_AVAILABLE:
     try:
         import cv2
         OPENCV_AVAILABLE = True
-        # Try to find the cascade file
-        cascade_paths = [
-            cv2.data.haarcascades + 'haarcascade_frontalface_default.xml',
-            'haarcascade_frontalface_default.xml',
-        ]
-        for path in cascade_paths:
-            if os.path.exists(path):
-                CASCADE_PATH = path
-                break
-        
-        if CASCADE_PATH:
-            print(f"[OK] OpenCV face detection loaded (cascade: {os.path.basename(CASCADE_PATH)})")
-        else:
-            print("[WARN] OpenCV loaded but no cascade file found - using mock detection")
     except Exception as e:
         print(f"[WARN] OpenCV not available: {e}")
 
+# Face detector backend, loaded once and reused by every request
+detector = select_detector(
+    FACE_DETECTOR, face_recognition if FACE_RECOGNITION_AVAILABLE else None, DETECTOR_POOL_SIZE
+)
+if detector.name == "mock" and OPENCV_AVAILABLE and FACE_DETECTOR != "mock":
+    print("[WARN] OpenCV loaded but no cascade file found - using mock detection")
+else:
+    print(f"[OK] Face detector: {detector.describe()}")
+
 if not FACE_RECOGNITION_AVAILABLE and not OPENCV_AVAILABLE:
     print("  Running in DEMO mode - using mock face recognition")
 
+# Image decode backend used by Frame
+image_decoder, image_decode = select_decoder(IMAGE_DECODER)
+print(f"[OK] Image decoder: {image_decoder}")
+
+# Last face box per camera, searched first on the next frame
+roi_tracker = ROITracker(ROI_MARGIN, DEVICE_STATE_MAX, DEVICE_STATE_TTL) if ROI_TRACKING else None
+
+# Last empty frame per camera, to skip detection while nothing changes
+frame_gate = FrameGate(FRAME_CHANGE_THRESHOLD, DEVICE_STATE_MAX, DEVICE_STATE_TTL) if FRAME_GATING else None
+
+# Multi-core exact search for large galleries
+sharded_searcher = ShardedSearcher(SEARCH_SHARDS, SEARCH_WORKERS) if SEARCH_SHARDS > 1 else None
+
+
+def decode_scale(size, max_side):
+    """
+    Reduction factor for decoding an image of `size` (width, height)
+    
+    Returns the smallest of 1, 2, 4 or 8 (the JPEG DCT scales) that keeps
+    the longer side within `max_side`, or 8 if none does.
+    """
+    if not max_side:
+        return 1
+    for scale in (1, 2, 4, 8):
+        if max(size) <= max_side * scale:
+            return scale
+    return 8
+
+
+class Frame:
+    """
+    Decoded request image that produces pixel arrays on demand
+    
+    Detection only needs luminance, so `gray` decodes just the JPEG Y
+    channel (no colour conversion, no 3-channel copy). `rgb` is only
+    decoded when an encoder needs colour, i.e. once a face was found.
+    
+    The header is read first (JPEG and PNG headers are parsed in place
+    by image_header, in microseconds). Frames outside `min_side` and
+    `max_pixels` are refused before anything is allocated, and images
+    larger than `max_side` are decoded at 1/2, 1/4 or 1/8 scale
+    (`reduce`), which JPEG does inside the DCT without ever allocating
+    the full-size frame. Both arrays share the same reduced size, so
+    boxes found on `gray` crop `rgb` correctly.
+    
+    Pixels come from `decode` (a decoders.py backend, the configured
+    IMAGE_DECODER by default).
+    """
+    
+    def __init__(self, image_data, max_side=DECODE_MAX_SIDE, decode=None,
+                 max_pixels=MAX_IMAGE_PIXELS, min_side=MIN_IMAGE_SIDE):
+        self.data = image_data
+        self.decode = decode or image_decode
+        self._gray = None
+        self._rgb = None
+        # Header only; other formats are identified by Pillow (raises on
+        # data that isn't an image)
+        header = probe_header(image_data)
+        if header is None:
+            with Image.open(io.BytesIO(image_data)) as image:
+                header = ImageHeader(image.format, *image.size, len(image.getbands()))
+        admit(header, min_side, max_pixels)
+        self.format = header.format
+        self.size = (header.width, header.height)
+        self.components = header.components
+        self.reduce = decode_scale(self.size, max_side)
+    
+    @property
+    def gray(self):
+        """(H, W) uint8 luminance plane"""
+        if self._gray is None:
+            if self._rgb is not None:
+                self._gray = np.asarray(Image.fromarray(self._rgb).convert('L'))
+            else:
+                self._gray = self.decode(self.data, 'L', self.reduce)
+        return self._gray
+    
+    @property
+    def rgb(self):
+        """(H, W, 3) uint8 RGB array (grayscale is expanded, alpha dropped)"""
+        if self._rgb is None:
+            self._rgb = self.decode(self.data, 'RGB', self.reduce)
+        return self._rgb
+
+
+def decode_frame(image):
+    """
+    Decode an uploaded image into a Frame for detection
+    
+    The luminance plane is decoded right away (so corrupt data fails
+    here); the RGB array is left until `frame.rgb` is used.
+    
+    Args:
+        image: Base64 encoded image string, or the raw file bytes
+            (used as they are, without a base64 round trip)
+        
+    Returns:
+        Frame, or None if failed
+    
+    Raises:
+        InvalidUpload: The header is malformed or outside MIN_IMAGE_SIDE /
+            MAX_IMAGE_PIXELS (one of image_header.HEADER_REJECTIONS)
+    """
+    try:
+        if not isinstance(image, (bytes, bytearray, memoryview)):
+            image = base64.b64decode(image)
+        frame = Frame(image)
+        frame.gray
+        return frame
+    except InvalidUpload:
+        raise
+    except Exception as e:
+        print(f"Error decoding image: {e}")
+        return None
+
 
 def decode_image(base64_string):
     """
@@ -74,56 +201,120 @@ def decode_image(base64_string):
         base64_string: Base64 encoded image
         
     Returns:
-        numpy array of image, or None if failed
+        RGB numpy array of image, or None if failed
     """
+    frame = decode_frame(base64_string)
+    if frame is None:
+        return None
     try:
-        image_data = base64.b64decode(base64_string)
-        image = Image.open(io.BytesIO(image_data))
-        image_array = np.array(image)
-        
-        # Convert to RGB if needed
-        if len(image_array.shape) == 2:
-            # Grayscale to RGB
-            image_array = np.stack([image_array] * 3, axis=-1)
-        elif len(image_array.shape) == 3 and image_array.shape[2] == 4:
-            # RGBA to RGB
-            image_array = image_array[:, :, :3]
-            
-        return image_array
+        return frame.rgb
     except Exception as e:
         print(f"Error decoding image: {e}")
         return None
 
 
-def detect_faces(image_array):
+def detect_faces(image_array, max_side=DETECT_MAX_SIDE, device_id=None):
     """
-    Detect faces in an image
+    Detect faces in an image with the active detector backend
+    
+    Large frames are searched on a copy downscaled to `max_side`
+    (detection cost grows with pixel count) and the boxes are mapped
+    back, so encoding still crops the full-resolution image.
+    
+    With a `device_id` (and ROI_TRACKING on), the region around that
+    camera's last face is searched first and the full frame only on a
+    miss.
     
     Args:
-        image_array: numpy array of image
+        image_array: numpy array of image (RGB or a 2-D luminance plane)
+        max_side: Longer side of the copy searched (None = full resolution)
+        device_id: Optional identity of the camera that sent the frame
         
     Returns:
         List of face locations as (top, right, bottom, left)
     """
-    if FACE_RECOGNITION_AVAILABLE:
-        return face_recognition.face_locations(image_array)
+    tracked = roi_tracker is not None and device_id is not None
+    if tracked:
+        region = roi_tracker.region(device_id, image_array.shape)
+        if region is not None:
+            top, right, bottom, left = region
+            found = _detect_scaled(image_array[top:bottom, left:right], max_side)
+            if found:
+                locations = [(t + top, r + left, b + top, l + left) for t, r, b, l in found]
+                roi_tracker.update(device_id, locations[0], image_array.shape)
+                return locations
     
-    if OPENCV_AVAILABLE and CASCADE_PATH:
-        import cv2
-        # Convert to grayscale
-        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
-        face_cascade = cv2.CascadeClassifier(CASCADE_PATH)
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4, minSize=(30, 30))
+    locations = _detect_scaled(image_array, max_side)
+    if tracked:
+        if locations:
+            roi_tracker.update(device_id, locations[0], image_array.shape)
+        else:
+            roi_tracker.forget(device_id)
+    return locations
+
+
+def frame_unchanged(gray, device_id):
+    """
+    True if a camera's frame matches its last frame without a face
+    
+    Args:
+        gray: Luminance plane of the new frame
+        device_id: Camera identity (None disables gating)
+    """
+    if frame_gate is None or device_id is None:
+        return False
+    return frame_gate.unchanged(device_id, gray)
+
+
+def record_frame(gray, device_id, has_face):
+    """Remember (or clear) a camera's empty frame for frame_unchanged"""
+    if frame_gate is not None and device_id is not None:
+        frame_gate.record(device_id, gray, has_face)
+
+
+def face_quality(gray, location):
+    """
+    Check a detected face against the configured quality thresholds
+    
+    Args:
+        gray: Luminance plane of the frame
+        location: Face box as (top, right, bottom, left)
         
-        # Convert from (x, y, w, h) to (top, right, bottom, left)
-        locations = []
-        for (x, y, w, h) in faces:
-            locations.append((y, x + w, y + h, x))
-        return locations
+    Returns:
+        None if the face is usable (or QUALITY_GATE is off), otherwise the
+        reason it was rejected
+    """
+    if not QUALITY_GATE:
+        return None
+    return check_face_quality(
+        gray, location, QUALITY_MIN_FACE_SIZE, QUALITY_MIN_SHARPNESS,
+        QUALITY_BRIGHTNESS, QUALITY_MAX_CLIPPED
+    )
+
+
+def _detect_scaled(image_array, max_side):
+    """Run the detector on a copy capped at `max_side` and map the boxes back"""
+    small, scale = downscale(image_array, max_side)
+    return upscale_locations(detector.detect(small), scale, image_array.shape)
+
+
+def warm_detector():
+    """
+    Load the detector and run it once
+    
+    Called at startup so no request pays for parsing the cascade: the
+    whole classifier pool is filled here and shared by request threads.
     
-    # Mock mode: always detect a face in the center
-    h, w = image_array.shape[:2]
-    return [(h//4, 3*w//4, 3*h//4, w//4)]
+    Returns:
+        Name of the active backend
+    """
+    detector.warm()
+    return detector.name
+
+
+def active_detector():
+    """Name of the detector backend in use"""
+    return detector.name
 
 
 def encode_face(image_array, face_location=None):
@@ -137,41 +328,229 @@ def encode_face(image_array, face_location=None):
     Returns:
         Face encoding (128-dimensional vector), or None if no face found
     """
-    if FACE_RECOGNITION_AVAILABLE:
-        if face_location:
-            encodings = face_recognition.face_encodings(image_array, [face_location])
-        else:
+    if face_location is None:
+        if FACE_RECOGNITION_AVAILABLE:
             encodings = face_recognition.face_encodings(image_array)
-        return encodings[0] if encodings else None
+            return encodings[0] if encodings else None
+        # Use center region
+        h, w = image_array.shape[:2]
+        face_location = (h//4, 3*w//4, 3*h//4, w//4)
+    
+    encodings = encode_faces(image_array, [face_location])
+    return encodings[0] if encodings else None
+
+
+def encode_faces(image_array, face_locations):
+    """
+    Encode several faces of one image in a single pass
+    
+    With face_recognition all locations go to one face_encodings call.
+    Otherwise fallback_encoder builds the simplified encodings on the
+    array itself with cv2.resize in float32; they agree with the ones
+    Pillow used to produce well within the match threshold, so stored
+    encodings stay valid.
+    
+    Args:
+        image_array: numpy array of image
+        face_locations: Face boxes as (top, right, bottom, left)
+        
+    Returns:
+        List of face encodings (128-dimensional vectors), one per location
+    """
+    if not face_locations:
+        return []
+    
+    if FACE_RECOGNITION_AVAILABLE:
+        return face_recognition.face_encodings(image_array, list(face_locations))
+    
+    return list(encode_crops(image_array, face_locations))
+
+
+def similarity_to_distance(similarities, norms, probe_norm):
+    """
+    Convert cosine similarities against the gallery into match distances
+
+    Args:
+        similarities: (N,) dot products of unit gallery rows with the unit probe
+        norms: (N,) original lengths of the gallery rows
+        probe_norm: original length of the probe encoding (or a (1, B) row
+            of lengths when `similarities` is an (N, B) batch)
+
+    Returns:
+        Distances shaped like `similarities` (Euclidean with
+        face_recognition, cosine otherwise)
+    """
+    if FACE_RECOGNITION_AVAILABLE:
+        # |a - b|^2 = |a|^2 + |b|^2 - 2|a||b|cos
+        squared = norms * norms + probe_norm * probe_norm - 2 * norms * probe_norm * similarities
+        return np.sqrt(np.maximum(squared, 0))
+    
+    # Convert to distance (0 = identical, 1 = different)
+    distances = 1 - (similarities + 1) / 2
+    return np.where((norms > 0) & (probe_norm > 0), distances, 1.0)
+
+
+def gallery_distances(known_encodings, face_to_check):
+    """
+    Distances from a probe to every gallery row with one matrix-vector product
+    
+    Args:
+        known_encodings: Gallery, or list/array of known face encodings
+        face_to_check: Face encoding to verify
+        
+    Returns:
+        (N,) numpy array of distances
+    """
+    probe, probe_norm = normalize_rows(face_to_check)
+    if isinstance(known_encodings, Gallery):
+        similarities = known_encodings.similarities(probe[0])
+        distances = similarity_to_distance(similarities, known_encodings.norms, probe_norm[0])
+        return mask_dead_rows(known_encodings, distances)
+    matrix, norms = normalize_rows(known_encodings)
+    return similarity_to_distance(matrix @ probe[0], norms, probe_norm[0])
+
+
+def live_rows(known_encodings):
+    """Number of rows a probe can match (a Gallery's tombstones don't count)"""
+    if isinstance(known_encodings, Gallery):
+        return known_encodings.live_count
+    return len(known_encodings)
+
+
+def mask_dead_rows(gallery, distances, rows=slice(None)):
+    """
+    Set the distances of tombstoned gallery rows to infinity
+    
+    Args:
+        gallery: Gallery the distances were computed against
+        distances: (N,) or (N, B) distances for `rows`
+        rows: Rows the distances belong to (default all rows)
+        
+    Returns:
+        The masked distances
+    """
+    if gallery.dead:
+        distances[~gallery.alive[rows]] = np.inf
+    return distances
+
+
+def top_k_smallest(distances, k):
+    """
+    Indices of the k smallest distances, nearest first
+    
+    Uses a partial sort (argpartition) so the cost stays O(n + k log k).
+    """
+    n = len(distances)
+    k = min(k, n)
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        candidates = np.argpartition(distances, k - 1)[:k]
     else:
-        # Create a simplified encoding based on face region
-        if face_location:
-            top, right, bottom, left = face_location
-            face_region = image_array[top:bottom, left:right]
-        else:
-            # Use center region
-            h, w = image_array.shape[:2]
-            face_region = image_array[h//4:3*h//4, w//4:3*w//4]
-        
-        # Create a simple encoding from the face region
-        # Resize to standard size and flatten
-        from PIL import Image as PILImage
-        face_img = PILImage.fromarray(face_region)
-        face_img = face_img.resize((16, 16))
-        small = np.array(face_img).flatten().astype(float)
-        
-        # Normalize and pad/truncate to 128 dimensions
-        if len(small) < 128:
-            encoding = np.pad(small, (0, 128 - len(small)))
-        else:
-            encoding = small[:128]
+        candidates = np.arange(n)
+    return candidates[np.argsort(distances[candidates], kind='stable')]
+
+
+def _row_ranker(known_encodings, face_to_check, k):
+    """
+    Score a probe against the gallery
+    
+    Returns:
+        Tuple of (nearest, total) where nearest(m) gives the (rows,
+        distances) of the m nearest scored rows, nearest first, and total is
+        the number of rows that were scored
+    """
+    is_gallery = isinstance(known_encodings, Gallery)
+    index = known_encodings.index if is_gallery else None
+    
+    if is_gallery and isinstance(known_encodings, MemmapGallery):
+        # Out-of-core: rescan with a running top-m instead of keeping all distances
+        probe, probe_norm = normalize_rows(face_to_check)
+        
+        def nearest(m):
+            return chunked_topk(known_encodings, probe[0], probe_norm[0], m, similarity_to_distance)
+        
+        return nearest, len(known_encodings)
+    
+    if index is not None:
+        probe, probe_norm = normalize_rows(face_to_check)
+        keys, similarities, norms = index.candidates(probe[0])
+        distances = similarity_to_distance(similarities, norms, probe_norm[0])
+        
+        def nearest(m):
+            order = top_k_smallest(distances, m)
+            rows = np.array([known_encodings.row_of(keys[p]) for p in order], dtype=np.int64)
+            return rows, distances[order]
         
-        # Normalize
-        norm = np.linalg.norm(encoding)
-        if norm > 0:
-            encoding = encoding / norm
+        return nearest, len(distances)
+    
+    if sharded_searcher and is_gallery and len(known_encodings) >= SHARD_MIN_ROWS:
+        probe, probe_norm = normalize_rows(face_to_check)
+        distances, first = sharded_searcher.search(
+            known_encodings, probe[0], probe_norm[0], k, similarity_to_distance, mask_dead_rows
+        )
+    else:
+        distances = gallery_distances(known_encodings, face_to_check)
+        first = None
+    
+    def nearest(m):
+        if first is not None and m == k:
+            order = first
+        elif m == 1:
+            order = np.array([np.argmin(distances)])
+        else:
+            order = top_k_smallest(distances, m)
+        return order, distances[order]
+    
+    return nearest, len(distances)
+
+
+def search_gallery(known_encodings, face_to_check, k=1):
+    """
+    Find the k nearest people in the gallery to a probe
+    
+    Uses the gallery's ANN index when one is attached, a chunked scan for
+    memory-mapped galleries, otherwise an exact scan of the whole gallery
+    (split across worker threads for galleries of SHARD_MIN_ROWS or more
+    when SEARCH_SHARDS > 1). A person with several templates is scored by
+    their best (nearest) template and appears at most once.
+    
+    Args:
+        known_encodings: Gallery, or list/array of known face encodings
+        face_to_check: Face encoding to verify
+        k: Number of people to return
         
-        return encoding
+    Returns:
+        Tuple of (rows, distances) as numpy arrays, nearest first, where each
+        row is the best-matching template row of a distinct person
+    """
+    nearest, total = _row_ranker(known_encodings, face_to_check, k)
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    
+    owners = known_encodings.ids if isinstance(known_encodings, Gallery) else None
+    if k == 1 or owners is None:
+        rows, distances = nearest(k)
+        # Tombstoned rows come back at infinite distance
+        live = np.isfinite(distances)
+        return rows[live], distances[live]
+    
+    # Widen the partial sort until it covers k distinct people
+    m = k
+    while True:
+        rows, distances = nearest(m)
+        live = np.isfinite(distances)
+        rows, distances = rows[live], distances[live]
+        picked, seen = [], set()
+        for position, row in enumerate(rows):
+            if owners[row] not in seen:
+                seen.add(owners[row])
+                picked.append(position)
+                if len(picked) == k:
+                    break
+        if len(picked) == k or m >= total:
+            return rows[picked], distances[picked]
+        m *= 4
 
 
 def compare_faces(known_encodings, face_to_check, threshold=0.6):
@@ -179,38 +558,97 @@ def compare_faces(known_encodings, face_to_check, threshold=0.6):
     Compare a face against known faces
     
     Args:
-        known_encodings: List of known face encodings
+        known_encodings: Gallery, or list/array of known face encodings
         face_to_check: Face encoding to verify
         threshold: Maximum distance for match (lower = stricter)
         
     Returns:
         Tuple of (best_match_index, distance, is_match)
     """
-    if not known_encodings:
+    if live_rows(known_encodings) == 0:
         return -1, 1.0, False
     
-    if FACE_RECOGNITION_AVAILABLE:
-        distances = face_recognition.face_distance(known_encodings, face_to_check)
+    rows, distances = search_gallery(known_encodings, face_to_check, 1)
+    if len(rows) == 0:
+        return -1, 1.0, False
+    best_distance = float(distances[0])
+    
+    return int(rows[0]), best_distance, best_distance < threshold
+
+
+def compare_faces_batch(known_encodings, faces_to_check, threshold=0.6):
+    """
+    Compare several probe faces against known faces at once
+    
+    All probes are scored with a single matrix-matrix product (or one
+    search per probe when an ANN index is attached or the gallery is
+    memory-mapped).
+    
+    Args:
+        known_encodings: Gallery, or list/array of known face encodings
+        faces_to_check: (B, D) array-like of face encodings
+        threshold: Maximum distance for match (lower = stricter)
+        
+    Returns:
+        List of (best_match_index, distance, is_match) per probe
+    """
+    if len(faces_to_check) == 0:
+        return []
+    if live_rows(known_encodings) == 0:
+        return [(-1, 1.0, False)] * len(faces_to_check)
+    
+    if isinstance(known_encodings, MemmapGallery) or (
+            isinstance(known_encodings, Gallery) and known_encodings.index is not None):
+        return [compare_faces(known_encodings, face, threshold) for face in faces_to_check]
+    
+    probes, probe_norms = normalize_rows(faces_to_check)
+    if isinstance(known_encodings, Gallery):
+        similarities = known_encodings.similarities(probes)
+        norms = known_encodings.norms
     else:
-        # Calculate cosine similarity converted to distance
-        face_to_check = np.array(face_to_check)
-        distances = []
-        for known in known_encodings:
-            known = np.array(known)
-            # Cosine similarity
-            dot = np.dot(known, face_to_check)
-            norm1 = np.linalg.norm(known)
-            norm2 = np.linalg.norm(face_to_check)
-            if norm1 > 0 and norm2 > 0:
-                similarity = dot / (norm1 * norm2)
-                # Convert to distance (0 = identical, 1 = different)
-                distance = 1 - (similarity + 1) / 2
-            else:
-                distance = 1.0
-            distances.append(distance)
+        matrix, norms = normalize_rows(known_encodings)
+        similarities = matrix @ probes.T
+    distances = similarity_to_distance(similarities, norms[:, None], probe_norms[None, :])
+    if isinstance(known_encodings, Gallery):
+        mask_dead_rows(known_encodings, distances)
+    best_rows = np.argmin(distances, axis=0)
+    best_distances = distances[best_rows, np.arange(len(best_rows))]
+    
+    return [
+        (int(row), float(dist), float(dist) < threshold) if np.isfinite(dist)
+        else (-1, 1.0, False)
+        for row, dist in zip(best_rows, best_distances)
+    ]
+
+
+def compare_faces_topk(known_encodings, face_to_check, k=3, threshold=0.6):
+    """
+    Find the k nearest known faces to a probe
+    
+    Args:
+        known_encodings: Gallery, or list/array of known face encodings
+        face_to_check: Face encoding to verify
+        k: Number of candidates to return
+        threshold: Maximum distance for match (lower = stricter)
+        
+    Returns:
+        Tuple of (candidates, margin, is_match) where candidates is a list of
+        (index, distance) nearest first and margin is the distance gap
+        between the first and second candidates (None with fewer than two).
+        candidates can be empty even for a non-empty gallery when an ANN
+        index finds nothing near the probe.
+    """
+    if live_rows(known_encodings) == 0:
+        return [], None, False
+    
+    rows, distances = search_gallery(known_encodings, face_to_check, max(k, 2))
+    if len(rows) == 0:
+        return [], None, False
+    candidates = [(int(row), float(dist)) for row, dist in zip(rows, distances)]
     
-    distances = np.array(distances)
-    best_match_idx = np.argmin(distances)
-    best_distance = distances[best_match_idx]
+    margin = None
+    if len(candidates) > 1:
+        margin = candidates[1][1] - candidates[0][1]
+    is_match = candidates[0][1] < threshold
     
-    return int(best_match_idx), float(best_distance), best_distance < threshold
+    return candidates[:max(k, 1)], margin, is_match
@@ -0,0 +1,62 @@
+# Fallback Face Encoder
+# 16x16 thumbnail encodings computed with cv2.resize in float32
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+THUMBNAIL_SIDE = 16
+ENCODING_DIMS = 128
+
+
+def resize_into(crop, out):
+    """
+    Shrink a face region into `out`, a 16x16 slot of the batch buffer
+
+    OpenCV's area averaging gives encodings within about 1e-4 cosine
+    distance of the Pillow bicubic thumbnails stored encodings were made
+    from, far below RECOGNITION_THRESHOLD, so they stay valid. Without
+    OpenCV, Pillow's own resize is used.
+    """
+    if crop.shape[0] == 0 or crop.shape[1] == 0:
+        raise ValueError("Empty face region")
+    size = (THUMBNAIL_SIDE, THUMBNAIL_SIDE)
+    if cv2 is not None:
+        cv2.resize(crop, size, dst=out, interpolation=cv2.INTER_AREA)
+    else:
+        out[...] = np.asarray(Image.fromarray(crop).resize(size))
+
+
+def encode_crops(image_array, face_locations):
+    """
+    Simplified encodings of several face regions
+
+    Every region is resized into one preallocated (N, 16, 16, C)
+    thumbnail buffer; the thumbnails are then flattened, padded or
+    truncated to 128 values and normalized for all faces at once, in
+    float32.
+
+    Args:
+        image_array: (H, W, 3) RGB or (H, W) grayscale uint8 image
+        face_locations: Face boxes as (top, right, bottom, left)
+
+    Returns:
+        (N, 128) float32 array of unit rows (zero rows stay zero)
+    """
+    count = len(face_locations)
+    shape = (count, THUMBNAIL_SIDE, THUMBNAIL_SIDE) + image_array.shape[2:]
+    thumbnails = np.empty(shape, dtype=image_array.dtype)
+    for out, (top, right, bottom, left) in zip(thumbnails, face_locations):
+        resize_into(image_array[top:bottom, left:right], out)
+
+    values = thumbnails.reshape(count, int(np.prod(shape[1:])))[:, :ENCODING_DIMS]
+    encodings = np.zeros((count, ENCODING_DIMS), dtype=np.float32)
+    encodings[:, :values.shape[1]] = values
+
+    norms = np.linalg.norm(encodings, axis=1, keepdims=True)
+    np.divide(encodings, norms, out=encodings, where=norms > 0)
+    return encodings
@@ -0,0 +1,60 @@
+# Frame-Change Gating
+# Skips detection for frames identical to a camera's last empty frame
+
+import numpy as np
+from PIL import Image
+from device_cache import DeviceCache
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+THUMBNAIL_SIZE = (32, 24)  # (width, height) of the frame signature
+
+
+def thumbnail(gray):
+    """Tiny float32 signature of a luminance plane (area-averaged, so sensor noise cancels)"""
+    if cv2 is not None:
+        small = cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    else:
+        small = np.asarray(Image.fromarray(gray).resize(THUMBNAIL_SIZE, Image.BOX))
+    return small.astype(np.float32)
+
+
+class FrameGate:
+    """
+    Remembers each camera's last frame that had no face
+
+    A new frame whose thumbnail cells all differ from that frame's by less
+    than `threshold` (absolute difference, 0-255 scale) shows the same
+    empty doorway, so the previous "No face detected" result still holds
+    and detection can be skipped. The largest cell difference is used,
+    not the mean: a small face only changes a few cells, which averaging
+    over the whole frame would hide (a 60 px face in a 640x480 frame is
+    about 1% of it). A frame with a face clears the entry, so
+    a person standing still is always re-verified. Entries are not
+    refreshed by skipped frames, so an unchanged scene is still checked
+    once every `ttl` seconds.
+    """
+
+    def __init__(self, threshold=8.0, max_devices=256, ttl=30.0):
+        self.threshold = threshold
+        self._empty = DeviceCache(max_devices, ttl)  # {device_id: thumbnail}
+
+    def unchanged(self, device_id, gray):
+        """True if `gray` matches the last empty frame from `device_id`"""
+        previous = self._empty.get(device_id)
+        if previous is None:
+            return False
+        current = thumbnail(gray)
+        if current.shape != previous.shape:
+            return False
+        return float(np.max(np.abs(current - previous))) < self.threshold
+
+    def record(self, device_id, gray, has_face):
+        """Store the frame's signature if it was empty, otherwise clear it"""
+        if has_face:
+            self._empty.pop(device_id)
+        else:
+            self._empty.put(device_id, thumbnail(gray))
@@ -0,0 +1,655 @@
+# Gallery Matrix
+# Contiguous float32 store of registered face encodings used for matching
+
+import copy
+import os
+import re
+import numpy as np
+from ann_index import spherical_kmeans
+from pq import unpack_codes
+
+ENCODING_SIZE = 128
+
+
+def normalize_rows(matrix):
+    """
+    Split a matrix of encodings into unit rows and their original lengths
+
+    Args:
+        matrix: (N, D) array-like of encodings
+
+    Returns:
+        Tuple of (unit_rows float32, norms float32)
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1).astype(np.float32)
+    safe = np.where(norms > 0, norms, 1.0).astype(np.float32)
+    return matrix / safe[:, None], norms
+
+
+def representative_templates(encodings, count, seed=0):
+    """
+    Pick a small representative subset of one person's templates
+
+    Clusters the templates by cosine similarity and keeps, for every
+    cluster, the real template closest to its centre, so a person enrolled
+    from many angles keeps one template per distinct pose.
+
+    Args:
+        encodings: (T, D) array-like of templates
+        count: Maximum number of templates to keep
+
+    Returns:
+        Sorted list of indices into `encodings`
+    """
+    if len(encodings) <= count:
+        return list(range(len(encodings)))
+    unit, _ = normalize_rows(encodings)
+    centroids = spherical_kmeans(unit, count, seed=seed)
+    similarities = unit @ centroids.T
+    keep = set()
+    for column in range(similarities.shape[1]):
+        for candidate in np.argsort(-similarities[:, column]):
+            if int(candidate) not in keep:
+                keep.add(int(candidate))
+                break
+    return sorted(keep)
+
+
+def open_row_file(path, capacity, dim=ENCODING_SIZE):
+    """New memory-mapped .npy file of `capacity` float32 rows"""
+    return np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(capacity, dim))
+
+
+def copy_rows(source, rows, path, capacity, chunk_rows=65536):
+    """
+    Copy `rows` of a row file into a new file at `path`, `chunk_rows` at a time
+
+    Returns:
+        The new memory-mapped (capacity, D) array
+    """
+    store = open_row_file(path, capacity, source.shape[1])
+    for start in range(0, len(rows), chunk_rows):
+        block = rows[start:start + chunk_rows]
+        store[start:start + len(block)] = source[block]
+    store.flush()
+    return store
+
+
+def next_row_file(path):
+    """
+    Name of the next generation of a row file
+
+    Rewrites never replace a row file that may still be mapped (which
+    fails on Windows) or that the faces file still points to; they go
+    to templates.1.npy, templates.2.npy, ... instead.
+    """
+    stem, ext = os.path.splitext(path)
+    base, _, generation = stem.rpartition(".")
+    if base and generation.isdigit():
+        return f"{base}.{int(generation) + 1}{ext}"
+    return f"{stem}.1{ext}"
+
+
+def row_file_generations(path):
+    """Existing generations of the row file first named `path` (including `path` itself)"""
+    stem, ext = os.path.splitext(path)
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"(\.\d+)?" + re.escape(ext) + "$")
+    directory = os.path.dirname(path)
+    return [
+        os.path.join(directory, name) for name in os.listdir(directory or ".")
+        if pattern.match(name)
+    ]
+
+
+class Gallery:
+    """
+    Pre-normalised float32 gallery with aligned id and name arrays
+
+    Each person owns one or more template rows. Row i of `matrix` is the
+    unit-length encoding of a template belonging to person `ids[i]`, named
+    `names[i]`. The original vector length is kept in `norms[i]` so that
+    Euclidean distances (face_recognition mode) can be recovered from a
+    single matrix-vector product. Every row also has a unique integer
+    template key (`keys[i]`) that stays stable while rows move around.
+    Storage grows geometrically so adds are amortised O(D). Removing a
+    person only tombstones their rows (`alive` goes False and matching
+    skips them); `compact` later drops all dead rows in one pass.
+
+    Rows below `size` are never rewritten in place: adds write past the
+    end, removes only clear `alive`, and growth/compaction allocate new
+    arrays and a new key map. That is what lets `snapshot` share nearly
+    everything with concurrent readers.
+
+    Subclasses can store rows in another form by overriding `_empty_store`,
+    `_encode_rows`, `matrix` and `similarities`.
+    """
+
+    path = None  # Row file behind the gallery, if any
+
+    def __init__(self, dim=ENCODING_SIZE, capacity=64, store=None):
+        self.dim = dim
+        self.size = 0
+        self._store = store if store is not None else self._empty_store(capacity)
+        capacity = len(self._store)
+        self._norms = np.zeros(capacity, dtype=np.float32)
+        self._ids = np.empty(capacity, dtype=object)
+        self._names = np.empty(capacity, dtype=object)
+        self._keys = np.zeros(capacity, dtype=np.int64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self.dead = 0  # Tombstoned rows awaiting compaction
+        self._row_of = np.full(capacity, -1, dtype=np.int64)  # Row of each template key (-1 = none),
+                                                               # removed keys kept until compaction
+        self._keys_of = {}     # {person_id: [template_key, ...]}, live gallery only
+        self._next_key = 0
+        self.index = None  # Optional ANN index kept in sync with the rows
+        self.version = 0  # Set on published snapshots
+        self._retired = []  # Earlier row files, removed by discard_retired
+
+    def _empty_store(self, capacity):
+        """Row storage for `capacity` templates"""
+        return np.zeros((capacity, self.dim), dtype=np.float32)
+
+    def _encode_rows(self, unit):
+        """Convert (T, D) unit encodings into stored rows"""
+        return unit
+
+    @classmethod
+    def from_faces(cls, faces, dim=ENCODING_SIZE, **kwargs):
+        """Build a gallery from `{person_id: {"name", "encodings"}}` in one pass"""
+        person_ids = [i for i in faces if faces[i]["encodings"]]
+        total = sum(len(faces[i]["encodings"]) for i in person_ids)
+        gallery = cls(dim=dim, capacity=max(64, total), **kwargs)
+        if not total:
+            return gallery
+        unit, norms = normalize_rows(
+            [e for i in person_ids for e in faces[i]["encodings"]]
+        )
+        owners = [i for i in person_ids for _ in faces[i]["encodings"]]
+        gallery._fill(gallery._encode_rows(unit), norms, owners, faces)
+        return gallery
+
+    def _fill(self, stored, norms, owners, faces):
+        """Load pre-encoded rows into an empty gallery"""
+        total = len(owners)
+        self._store[:total] = stored
+        self._norms[:total] = norms
+        self._ids[:total] = owners
+        self._names[:total] = [faces[i]["name"] for i in owners]
+        self._keys[:total] = np.arange(total)
+        self._alive[:total] = True
+        self._row_of[:total] = np.arange(total)
+        for row, person_id in enumerate(owners):
+            self._keys_of.setdefault(person_id, []).append(row)
+        self._next_key = total
+        self.size = total
+
+    def _place(self, faces):
+        """
+        Load the metadata of rows already in the store from
+        `{person_id: {"name", "rows", "norms"}}`
+
+        Template key k is row k; rows no person refers to stay dead.
+        """
+        size = 0
+        for person_id, data in faces.items():
+            for row, norm in zip(data.get("rows", []), data.get("norms", [])):
+                self._norms[row] = norm
+                self._ids[row] = person_id
+                self._names[row] = data["name"]
+                self._keys[row] = row
+                self._alive[row] = True
+                self._row_of[row] = row
+                size = max(size, row + 1)
+            if data.get("rows"):
+                self._keys_of[person_id] = list(data["rows"])
+        self.size = size
+        self.dead = size - int(self.alive.sum())
+        self._next_key = size
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, person_id):
+        return person_id in self._keys_of
+
+    @property
+    def person_count(self):
+        """People with templates (live gallery only, snapshots drop the person map)"""
+        return len(self._keys_of)
+
+    @property
+    def live_count(self):
+        """Rows that still belong to someone (tombstones excluded)"""
+        return self.size - self.dead
+
+    @property
+    def dead_ratio(self):
+        """Fraction of rows that are tombstones"""
+        return self.dead / self.size if self.size else 0.0
+
+    def row_of(self, key):
+        """Current row of template `key`, or None if it was removed"""
+        if key >= len(self._row_of):
+            return None
+        row = int(self._row_of[key])
+        if row < 0 or row >= self.size or not self._alive[row]:
+            return None
+        return row
+
+    def rows_of(self, person_id):
+        """Rows currently holding `person_id`'s templates"""
+        return self._row_of[self._keys_of.get(person_id, [])].tolist()
+
+    def template_count(self, person_id):
+        """Number of templates `person_id` has in the gallery"""
+        return len(self._keys_of.get(person_id, ()))
+
+    def snapshot(self):
+        """
+        Frozen copy of the gallery for readers on other threads
+
+        Row storage, norms, keys, ids, names and the key -> row map are
+        shared with the live gallery: writers only append past `size` (and
+        add new keys to the map), and growth and compaction replace them
+        instead of editing them. Only the `alive` mask, which `remove`
+        clears in place, is copied (one byte per row), and the attached
+        index is snapshotted against the copy. Readers never look up
+        people, so the person -> keys map is left out.
+        """
+        frozen = copy.copy(self)
+        frozen._alive = self._alive[:self.size].copy()
+        frozen._keys_of = None
+        if self.index is not None:
+            frozen.index = self.index.snapshot(frozen)
+        return frozen
+
+    def flush(self):
+        """Write pending rows to disk (in-memory galleries have none)"""
+
+    def _rewrite_row_file(self, source, rows, capacity):
+        """
+        Copy `rows` of `source` into the next generation of the row file
+
+        The current file is only retired: snapshots may still map it and
+        the saved faces file still points to it.
+        """
+        path = next_row_file(self.path)
+        store = copy_rows(source, rows, path, capacity, self.chunk_rows)
+        self._retired.append(self.path)
+        self.path = path
+        return store
+
+    def discard_retired(self):
+        """
+        Delete row files replaced by a rewrite
+
+        Call once the faces file points at the current row file. Files
+        that cannot be removed yet (still mapped by a snapshot on Windows)
+        are retried on the next call.
+        """
+        retired, self._retired = self._retired, []
+        for path in retired:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                self._retired.append(path)
+
+    def attach_index(self, index):
+        """Build `index` over the current rows and keep it updated on add/remove"""
+        self.index = index.build(self) if index is not None else None
+        return self.index
+
+    @property
+    def matrix(self):
+        """(N, D) view of the unit-length encodings"""
+        return self._store[:self.size]
+
+    def unit_vectors(self, rows):
+        """Unit encodings of `rows` (a slice or index array)"""
+        return self._store[rows]
+
+    @property
+    def norms(self):
+        """(N,) view of the original encoding lengths"""
+        return self._norms[:self.size]
+
+    @property
+    def ids(self):
+        """(N,) view of person ids aligned with `matrix` rows"""
+        return self._ids[:self.size]
+
+    @property
+    def names(self):
+        """(N,) view of names aligned with `matrix` rows"""
+        return self._names[:self.size]
+
+    @property
+    def keys(self):
+        """(N,) view of template keys aligned with `matrix` rows"""
+        return self._keys[:self.size]
+
+    @property
+    def alive(self):
+        """(N,) mask of rows that still belong to someone"""
+        return self._alive[:self.size]
+
+    def similarities(self, units, rows=None):
+        """
+        Cosine similarities of gallery rows with one or more unit probes
+
+        Args:
+            units: (D,) probe or (B, D) batch of unit probes
+            rows: Optional row indices to score (default all rows)
+
+        Returns:
+            (N,) or (N, B) float32 similarities
+        """
+        matrix = self.matrix if rows is None else self._store[rows]
+        return matrix @ np.asarray(units, dtype=np.float32).T
+
+    def _grow(self, needed):
+        capacity = len(self._store)
+        while capacity < needed:
+            capacity = max(64, 2 * capacity)
+        store = self._grown_store(capacity)
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:self.size] = self.norms
+        ids = np.empty(capacity, dtype=object)
+        ids[:self.size] = self.ids
+        names = np.empty(capacity, dtype=object)
+        names[:self.size] = self.names
+        keys = np.zeros(capacity, dtype=np.int64)
+        keys[:self.size] = self.keys
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:self.size] = self.alive
+        self._store, self._norms, self._ids, self._names, self._keys, self._alive = (
+            store, norms, ids, names, keys, alive
+        )
+
+    def _grown_store(self, capacity):
+        """Copy of the row storage with room for `capacity` templates"""
+        store = self._empty_store(capacity)
+        store[:self.size] = self._store[:self.size]
+        return store
+
+    def add(self, person_id, name, encodings):
+        """
+        Set the templates of `person_id`, replacing any existing ones
+
+        Args:
+            person_id: Person the templates belong to
+            name: Person's name
+            encodings: One encoding or a (T, D) array-like of encodings
+
+        Returns:
+            List of rows holding the new templates
+        """
+        unit, norms = normalize_rows(encodings)
+        return self.add_rows(person_id, name, self._encode_rows(unit), norms, unit)
+
+    def add_rows(self, person_id, name, stored, norms, unit=None):
+        """
+        Set the templates of `person_id` from already-encoded rows
+
+        Args:
+            person_id: Person the templates belong to
+            name: Person's name
+            stored: (T, ...) rows in this gallery's storage format
+            norms: (T,) original encoding lengths
+            unit: Optional (T, D) unit encodings for the ANN index
+
+        Returns:
+            List of rows holding the new templates
+        """
+        self.remove(person_id)
+        count = len(stored)
+        if self.size + count > len(self._store):
+            self._grow(self.size + count)
+
+        start = self.size
+        rows = list(range(start, start + count))
+        keys = list(range(self._next_key, self._next_key + count))
+        self._next_key += count
+        if self._next_key > len(self._row_of):
+            # A new map, snapshots keep reading the old one
+            row_of = np.full(max(64, 2 * self._next_key), -1, dtype=np.int64)
+            row_of[:len(self._row_of)] = self._row_of
+            self._row_of = row_of
+        self._store[start:start + count] = stored
+        self._norms[start:start + count] = norms
+        self._ids[start:start + count] = [person_id] * count
+        self._names[start:start + count] = [name] * count
+        self._keys[start:start + count] = keys
+        self._alive[start:start + count] = True
+        self._row_of[keys] = rows
+        self._keys_of[person_id] = keys
+        self.size += count
+
+        if self.index is not None:
+            if unit is None:
+                unit = self.unit_vectors(slice(start, start + count))
+            for offset, key in enumerate(keys):
+                self.index.add(key, unit[offset], norms[offset])
+        return rows
+
+    def remove(self, person_id):
+        """
+        Tombstone all templates of `person_id`
+
+        Rows are not moved: they are marked dead in `alive`, which every
+        scan masks out, and are dropped by the next `compact`. Their ids,
+        names and key map entries stay until then, since snapshots share
+        them.
+        """
+        keys = self._keys_of.pop(person_id, None)
+        if keys is None:
+            return False
+        if self.index is not None:
+            for key in keys:
+                self.index.remove(key)
+        self._alive[self._row_of[keys]] = False
+        self.dead += len(keys)
+        return True
+
+    def compact(self):
+        """
+        Drop tombstoned rows, packing live rows to the front in order
+
+        Template keys are unchanged, so an attached index stays valid.
+
+        Returns:
+            Number of rows dropped
+        """
+        dropped = self.dead
+        if not dropped:
+            return 0
+        live = np.flatnonzero(self.alive)
+        count = len(live)
+        capacity = max(64, count)
+        store = self._compacted_store(live, capacity)
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[:count] = self._norms[live]
+        ids = np.empty(capacity, dtype=object)
+        ids[:count] = self._ids[live]
+        names = np.empty(capacity, dtype=object)
+        names[:count] = self._names[live]
+        keys = np.zeros(capacity, dtype=np.int64)
+        keys[:count] = self._keys[live]
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:count] = True
+        self._store, self._norms, self._ids, self._names, self._keys, self._alive = (
+            store, norms, ids, names, keys, alive
+        )
+        row_of = np.full(len(self._row_of), -1, dtype=np.int64)
+        row_of[keys[:count]] = np.arange(count)
+        self._row_of = row_of
+        self.size = count
+        self.dead = 0
+        return dropped
+
+    def _compacted_store(self, live, capacity):
+        """Row storage holding only rows `live`, with room for `capacity` templates"""
+        store = self._empty_store(capacity)
+        store[:len(live)] = self._store[live]
+        return store
+
+
+class PQGallery(Gallery):
+    """
+    Gallery that keeps product-quantized uint8 codes instead of float rows
+
+    Uses `subspaces` bytes per template. Matching goes through asymmetric
+    lookup tables without decoding. With a `path`, the exact unit rows
+    are also kept in a memory-mapped row file, row for row with the
+    codes, and `unit_vectors`/`matrix` read them from there (otherwise
+    they are reconstructed from the codes). The file replaces the float
+    encodings in memory and lets the templates be restored exactly.
+    """
+
+    def __init__(self, dim=ENCODING_SIZE, capacity=64, quantizer=None, path=None, exact=None,
+                 chunk_rows=65536):
+        self.quantizer = quantizer
+        self.path = path
+        self.chunk_rows = chunk_rows
+        if exact is not None:
+            capacity = len(exact)
+        super().__init__(dim=dim, capacity=capacity)
+        self._exact = None
+        if path is not None:
+            self._exact = exact if exact is not None else open_row_file(path, len(self._store), dim)
+
+    def _empty_store(self, capacity):
+        return np.zeros((capacity, self.quantizer.subspaces), dtype=np.uint8)
+
+    def _encode_rows(self, unit):
+        return self.quantizer.encode(unit)
+
+    @classmethod
+    def open(cls, path, faces, quantizer, dim=ENCODING_SIZE, chunk_rows=65536):
+        """
+        Attach to an existing row file using
+        `{person_id: {"name", "rows", "norms", "codes"}}`
+
+        People without codes (the file was written in "mmap" mode) are
+        encoded from their exact rows.
+        """
+        exact = np.load(path, mmap_mode='r+')
+        gallery = cls(dim=dim, quantizer=quantizer, path=path, exact=exact, chunk_rows=chunk_rows)
+        gallery._place(faces)
+        uncoded = []
+        for data in faces.values():
+            if data.get("codes"):
+                gallery._store[data["rows"]] = np.stack([unpack_codes(c) for c in data["codes"]])
+            else:
+                uncoded.extend(data.get("rows", []))
+        if uncoded:
+            gallery._store[uncoded] = quantizer.encode(exact[uncoded])
+        return gallery
+
+    @property
+    def codes(self):
+        """(N, subspaces) view of the stored codes"""
+        return self._store[:self.size]
+
+    @property
+    def matrix(self):
+        """(N, D) unit encodings (exact with a row file, reconstructed otherwise)"""
+        if self._exact is not None:
+            return self._exact[:self.size]
+        return self.quantizer.decode(self.codes)
+
+    def unit_vectors(self, rows):
+        if self._exact is not None:
+            return self._exact[rows]
+        return self.quantizer.decode(self._store[rows])
+
+    def similarities(self, units, rows=None):
+        codes = self.codes if rows is None else self._store[rows]
+        units = np.asarray(units, dtype=np.float32)
+        if units.ndim == 1:
+            return self.quantizer.similarities(codes, units)
+        return np.stack([self.quantizer.similarities(codes, u) for u in units], axis=1)
+
+    def add_rows(self, person_id, name, stored, norms, unit=None):
+        if self._exact is not None and unit is None:
+            raise ValueError("PQGallery with a row file needs the unit encodings")
+        rows = super().add_rows(person_id, name, stored, norms, unit)
+        if self._exact is not None and rows:
+            self._exact[rows[0]:rows[-1] + 1] = unit
+        return rows
+
+    def _grown_store(self, capacity):
+        if self._exact is not None:
+            self._exact = self._rewrite_row_file(self._exact, np.arange(self.size), capacity)
+        return super()._grown_store(capacity)
+
+    def _compacted_store(self, live, capacity):
+        if self._exact is not None:
+            self._exact = self._rewrite_row_file(self._exact, live, capacity)
+        return super()._compacted_store(live, capacity)
+
+    def flush(self):
+        """Write dirty pages of the row file to disk"""
+        if self._exact is not None:
+            self._exact.flush()
+
+
+class MemmapGallery(Gallery):
+    """
+    Append-only gallery whose unit rows live in a memory-mapped .npy file
+
+    Only norms, ids and names stay resident; the encodings are paged in
+    from disk while `chunk_rows` rows at a time are scanned. Template key
+    k is row k of the file; rows only move when `compact` rewrites the
+    file without the dead rows.
+    """
+
+    def __init__(self, dim=ENCODING_SIZE, capacity=64, store=None, path=None, chunk_rows=65536):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        super().__init__(dim=dim, capacity=capacity, store=store)
+
+    def _empty_store(self, capacity):
+        return open_row_file(self.path, capacity, self.dim)
+
+    def _grown_store(self, capacity):
+        return self._rewrite_row_file(self._store, np.arange(self.size), capacity)
+
+    def _compacted_store(self, live, capacity):
+        return self._rewrite_row_file(self._store, live, capacity)
+
+    @classmethod
+    def open(cls, path, faces, dim=ENCODING_SIZE, chunk_rows=65536):
+        """
+        Attach to an existing file using `{person_id: {"name", "rows", "norms"}}`
+
+        Rows not referenced by any person are left dead.
+        """
+        store = np.load(path, mmap_mode='r+')
+        gallery = cls(dim=dim, store=store, path=path, chunk_rows=chunk_rows)
+        gallery._place(faces)
+        return gallery
+
+    def compact(self):
+        """Rewrite the file without dead rows and renumber keys to match rows"""
+        dropped = super().compact()
+        if dropped:
+            new_key = {int(key): row for row, key in enumerate(self.keys)}
+            self._keys_of = {
+                person_id: [new_key[key] for key in keys]
+                for person_id, keys in self._keys_of.items()
+            }
+            self._keys[:self.size] = np.arange(self.size)
+            self._row_of = np.full(len(self._store), -1, dtype=np.int64)
+            self._row_of[:self.size] = np.arange(self.size)
+            self._next_key = self.size
+        return dropped
+
+    def flush(self):
+        """Write dirty pages of the row file to disk"""
+        self._store.flush()
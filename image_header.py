@@ -0,0 +1,106 @@
+# Image Header Probe
+# Reads dimensions from the first bytes of a JPEG or PNG without decoding it
+
+import struct
+from collections import namedtuple
+from ingest import InvalidUpload, UploadTooLarge, IMAGE_TOO_LARGE
+
+ImageHeader = namedtuple('ImageHeader', 'format width height components')
+
+# Client-facing reasons for frames refused from their header
+IMAGE_TOO_SMALL = "Image too small"
+INVALID_HEADER = "Invalid image header"
+HEADER_REJECTIONS = (IMAGE_TOO_LARGE, IMAGE_TOO_SMALL, INVALID_HEADER)
+
+JPEG_SIGNATURE = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Start-of-frame markers (every JPEG coding process except DHT/JPG/DAC)
+JPEG_SOF = frozenset((0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF))
+JPEG_SOS = 0xDA
+# Markers without a length field (TEM, RSTn)
+JPEG_STANDALONE = frozenset((0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7))
+
+# Channels per PNG colour type (palette images decode to RGB)
+PNG_COMPONENTS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def probe_jpeg(data):
+    """Walk the JPEG marker segments up to the start-of-frame"""
+    i = 2
+    end = len(data)
+    while i + 4 <= end:
+        if data[i] != 0xFF:
+            raise InvalidUpload(INVALID_HEADER)
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE:
+            i += 2
+            continue
+        length = (data[i + 2] << 8) | data[i + 3]
+        if marker in JPEG_SOF:
+            if length < 8 or i + 10 > end:
+                break
+            height, width = struct.unpack_from('>HH', data, i + 5)
+            return ImageHeader('JPEG', width, height, data[i + 9])
+        if marker == JPEG_SOS or length < 2:
+            break
+        i += 2 + length
+    raise InvalidUpload(INVALID_HEADER)
+
+
+def probe_png(data):
+    """Read the IHDR chunk, which the PNG spec requires to come first"""
+    if len(data) < 26 or data[12:16] != b'IHDR':
+        raise InvalidUpload(INVALID_HEADER)
+    width, height = struct.unpack_from('>II', data, 16)
+    components = PNG_COMPONENTS.get(data[25])
+    if components is None:
+        raise InvalidUpload(INVALID_HEADER)
+    return ImageHeader('PNG', width, height, components)
+
+
+def probe_header(data):
+    """
+    Dimensions of a JPEG or PNG from its header bytes
+
+    Args:
+        data: Encoded image (bytes, bytearray or memoryview)
+
+    Returns:
+        ImageHeader(format, width, height, components), or None for other
+        formats (left to the decoder to identify)
+
+    Raises:
+        InvalidUpload: JPEG/PNG signature with a malformed header
+    """
+    if data[:2] == JPEG_SIGNATURE:
+        return probe_jpeg(data)
+    if data[:8] == PNG_SIGNATURE:
+        return probe_png(data)
+    return None
+
+
+def admit(header, min_side, max_pixels):
+    """
+    Refuse frames whose header puts them outside the accepted bounds
+
+    Args:
+        header: ImageHeader of the upload
+        min_side: Smallest accepted width and height (None/0 = no limit)
+        max_pixels: Largest accepted width x height (None/0 = no limit)
+
+    Raises:
+        InvalidUpload: Zero-sized or unsupported channel count
+        UploadTooLarge: More than `max_pixels`
+        InvalidUpload(IMAGE_TOO_SMALL): A side shorter than `min_side`
+    """
+    if header.width == 0 or header.height == 0 or not 1 <= header.components <= 4:
+        raise InvalidUpload(INVALID_HEADER)
+    if max_pixels and header.width * header.height > max_pixels:
+        raise UploadTooLarge()
+    if min_side and min(header.width, header.height) < min_side:
+        raise InvalidUpload(IMAGE_TOO_SMALL)
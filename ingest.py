@@ -0,0 +1,233 @@
+# Request Ingest
+# Reads uploaded images out of request bodies in bounded memory
+
+import binascii
+import json
+
+CHUNK_SIZE = 64 * 1024  # Bytes read from the request stream at a time
+MAX_FIELDS_BYTES = 64 * 1024  # Largest JSON body apart from the image itself
+
+# Client-facing reasons carried by the exceptions below
+INVALID_IMAGE = "Invalid image"
+INVALID_REQUEST = "Invalid request"
+IMAGE_TOO_LARGE = "Image too large"
+
+WHITESPACE = b' \t\r\n'
+BASE64_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='
+QUOTE, BACKSLASH, COLON = ord('"'), ord('\\'), ord(':')
+
+
+class InvalidUpload(ValueError):
+    """Request that doesn't carry a usable image (the message is the reason)"""
+
+
+class UploadTooLarge(InvalidUpload):
+    """Image over MAX_UPLOAD_BYTES, or over MAX_IMAGE_PIXELS once its header is read"""
+
+    def __init__(self, message=IMAGE_TOO_LARGE):
+        super().__init__(message)
+
+
+def initial_capacity(max_bytes, size_hint):
+    """Buffer size to preallocate for an image of at most `max_bytes`"""
+    return min(max_bytes, size_hint) if size_hint else min(max_bytes, CHUNK_SIZE)
+
+
+def read_body(stream, max_bytes, size_hint=None):
+    """
+    Read a raw image body into a single preallocated buffer
+
+    Args:
+        stream: Request body stream
+        max_bytes: Largest accepted body
+        size_hint: Content-Length, if the client sent one
+
+    Returns:
+        bytearray holding the body (empty if there was none)
+
+    Raises:
+        UploadTooLarge: The body is longer than `max_bytes`, checked from
+            Content-Length before reading anything when available
+    """
+    if size_hint and size_hint > max_bytes:
+        raise UploadTooLarge()
+    buffer = bytearray(initial_capacity(max_bytes, size_hint))
+    size = 0
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if size + len(chunk) > max_bytes:
+            raise UploadTooLarge()
+        buffer[size:size + len(chunk)] = chunk
+        size += len(chunk)
+    del buffer[size:]
+    return buffer
+
+
+class JSONImageReader:
+    """
+    Incremental reader for a JSON object with a large base64 string field
+
+    Bytes are fed in as they arrive. The field's value is base64-decoded
+    4 characters at a time straight into one preallocated buffer, so the
+    base64 text is never held as a whole and the full JSON body, the
+    parsed string and the decoded copy never coexist. Everything else in
+    the object is kept as JSON text with the field's value replaced by
+    null, and parsed at the end (it is limited to MAX_FIELDS_BYTES).
+
+    Escapes JSON encoders put inside base64 (\\/ and \\n line breaks) are
+    handled; any other character outside the base64 alphabet makes the
+    image invalid. The field only counts as a top-level key.
+    """
+
+    def __init__(self, field, max_bytes, size_hint=None):
+        self.field = field
+        self.key = json.dumps(field).encode()
+        self.max_bytes = max_bytes
+        self.size_hint = size_hint
+        self.text = bytearray()  # The JSON minus the image value
+        self.image = None
+        self.size = 0
+        self._in_image = False
+        self._in_string = False
+        self._escape = False
+        self._depth = 0
+        self._string_start = 0
+        self._last_string = None
+        self._value_key = None  # Key whose value comes next
+        self._cut_escape = b''  # Backslash split from its escape by a chunk boundary
+        self._quantum = b''  # Base64 characters short of a 4-character group
+
+    def feed(self, chunk):
+        i = 0
+        while i < len(chunk):
+            if self._in_image:
+                end = chunk.find(b'"', i)
+                self._decode(chunk[i:] if end < 0 else chunk[i:end])
+                if end < 0:
+                    return
+                self._end_image()
+                i = end + 1
+                continue
+
+            byte = chunk[i]
+            i += 1
+            if len(self.text) >= MAX_FIELDS_BYTES:
+                raise InvalidUpload(INVALID_REQUEST)
+
+            if self._in_string:
+                self.text.append(byte)
+                if self._escape:
+                    self._escape = False
+                elif byte == BACKSLASH:
+                    self._escape = True
+                elif byte == QUOTE:
+                    self._in_string = False
+                    self._last_string = bytes(self.text[self._string_start:])
+                continue
+
+            if byte == QUOTE and self._depth == 1 and self._value_key == self.key:
+                self._start_image()
+                continue
+            if byte == QUOTE:
+                self._in_string = True
+                self._string_start = len(self.text)
+            self.text.append(byte)
+
+            if byte == COLON and self._depth == 1:
+                self._value_key = self._last_string
+            elif byte not in WHITESPACE:
+                self._value_key = None
+            if byte in b'{[':
+                self._depth += 1
+            elif byte in b'}]':
+                self._depth -= 1
+
+    def _start_image(self):
+        self.text += b'null'
+        self._in_image = True
+        self._value_key = None
+        # Base64 is 4/3 the size of what it encodes
+        hint = self.size_hint * 3 // 4 if self.size_hint else None
+        self.image = bytearray(initial_capacity(self.max_bytes, hint))
+        self.size = 0
+
+    def _decode(self, encoded):
+        """Decode the complete 4-character groups of `encoded` into the buffer"""
+        encoded = self._cut_escape + encoded
+        self._cut_escape = b''
+        if encoded.endswith(b'\\'):
+            self._cut_escape, encoded = b'\\', encoded[:-1]
+        if b'\\' in encoded:
+            encoded = encoded.replace(b'\\/', b'/')
+            for escape in (b'\\n', b'\\r', b'\\t'):
+                encoded = encoded.replace(escape, b'')
+
+        encoded = self._quantum + encoded
+        usable = len(encoded) - len(encoded) % 4
+        self._quantum = encoded[usable:]
+        if not usable:
+            return
+        if encoded[:usable].translate(None, BASE64_CHARS):
+            # a2b_base64 would skip these, shifting every group after them
+            raise InvalidUpload(INVALID_IMAGE)
+        try:
+            decoded = binascii.a2b_base64(encoded[:usable])
+        except binascii.Error:
+            raise InvalidUpload(INVALID_IMAGE)
+        if self.size + len(decoded) > self.max_bytes:
+            raise UploadTooLarge()
+        self.image[self.size:self.size + len(decoded)] = decoded
+        self.size += len(decoded)
+
+    def _end_image(self):
+        self._in_image = False
+        if self._quantum or self._cut_escape:
+            # Unpadded or truncated base64
+            raise InvalidUpload(INVALID_IMAGE)
+        del self.image[self.size:]
+
+    def close(self):
+        """
+        Returns:
+            Tuple of (fields dict without the image, image bytearray or None)
+        """
+        if self._in_image:
+            raise InvalidUpload(INVALID_REQUEST)
+        try:
+            fields = json.loads(self.text)
+        except ValueError:
+            raise InvalidUpload(INVALID_REQUEST)
+        if not isinstance(fields, dict):
+            return {}, None
+        image = fields.pop(self.field, None)
+        if self.image is not None:
+            image = self.image
+        return fields, image or None
+
+
+def read_json_image(stream, max_bytes, size_hint=None, field='image'):
+    """
+    Stream a JSON body, decoding its base64 `field` in bounded memory
+
+    Args:
+        stream: Request body stream
+        max_bytes: Largest accepted decoded image
+        size_hint: Content-Length, if the client sent one
+
+    Returns:
+        Tuple of (other fields, image bytes or None)
+
+    Raises:
+        UploadTooLarge: The decoded image would exceed `max_bytes`
+        InvalidUpload: Malformed JSON or base64, or other fields over
+            MAX_FIELDS_BYTES
+    """
+    reader = JSONImageReader(field, max_bytes, size_hint)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        reader.feed(chunk)
+    return reader.close()
@@ -0,0 +1,149 @@
+# PCA Matching Cascade
+# Coarse-to-fine search: low-dimensional PCA scan, exact rescoring of a shortlist
+
+import copy
+import numpy as np
+
+
+class PCACascade:
+    """
+    Two-stage matcher attached to a gallery like an ANN index
+
+    Stage one scores every gallery row in a `dims`-dimensional PCA
+    projection fitted on the enrolled encodings. Stage two rescores only
+    the `shortlist` best rows at full precision against the gallery's unit
+    rows (for a PQGallery, the exact rows in its row file, or the decoded
+    codes when it has none), so the final decision is exact whenever the
+    true nearest row makes the shortlist. The projection is refit once
+    more than `refit_fraction` of the gallery has changed since the last
+    fit.
+
+    Like the gallery, projected rows are append-only: removing a template
+    only clears its `alive` flag until the next refit, and growth
+    allocates new arrays, so snapshots share the projected rows.
+    """
+
+    def __init__(self, dims=32, shortlist=200, refit_fraction=0.2):
+        self.dims = dims
+        self.shortlist = shortlist
+        self.refit_fraction = refit_fraction
+        self.gallery = None
+        self.mean = None
+        self.components = None  # (dims, D)
+        self.size = 0
+        self.fitted_size = 0
+        self.changes = 0
+        self._projected = np.zeros((0, dims), dtype=np.float32)
+        self._offsets = np.zeros(0, dtype=np.float32)  # row . mean
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._alive = np.zeros(0, dtype=bool)
+        self.live = 0
+        self._position_of = {}  # {template_key: position}, live entries only
+
+    def build(self, gallery):
+        """Fit the projection on a gallery and project all its live rows"""
+        live = np.flatnonzero(gallery.alive)
+        matrix = gallery.matrix[live]
+        keys = gallery.keys[live]
+        self.gallery = gallery
+        self.mean = matrix.mean(axis=0).astype(np.float32)
+        # Principal axes of the centred gallery
+        _, _, vt = np.linalg.svd(matrix - self.mean, full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:self.dims], dtype=np.float32)
+
+        n = len(matrix)
+        capacity = max(64, n)
+        self._projected = np.zeros((capacity, len(self.components)), dtype=np.float32)
+        self._projected[:n] = (matrix - self.mean) @ self.components.T
+        self._offsets = np.zeros(capacity, dtype=np.float32)
+        self._offsets[:n] = matrix @ self.mean
+        self._keys = np.zeros(capacity, dtype=np.int64)
+        self._keys[:n] = keys
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._alive[:n] = True
+        self._position_of = {int(key): position for position, key in enumerate(keys)}
+
+        self.size = n
+        self.live = n
+        self.fitted_size = n
+        self.changes = 0
+        return self
+
+    def snapshot(self, gallery):
+        """
+        Read-only copy bound to a gallery snapshot
+
+        Projected rows, offsets and keys are shared (writers only append
+        past `size`); only the `alive` mask is copied.
+        """
+        frozen = copy.copy(self)
+        frozen.gallery = gallery
+        frozen._alive = self._alive[:self.size].copy()
+        frozen._position_of = None
+        return frozen
+
+    def needs_retrain(self):
+        """True once enough rows were added or removed to warrant a refit"""
+        return self.changes > self.refit_fraction * max(self.fitted_size, 1)
+
+    def add(self, key, unit, norm):
+        """Project and append one unit template encoding"""
+        if key in self._position_of:
+            self.remove(key)
+        if self.size == len(self._keys):
+            capacity = 2 * len(self._keys)
+            for name in ("_projected", "_offsets", "_keys", "_alive"):
+                old = getattr(self, name)
+                grown = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                grown[:self.size] = old[:self.size]
+                setattr(self, name, grown)
+        position = self.size
+        self._projected[position] = (unit - self.mean) @ self.components.T
+        self._offsets[position] = unit @ self.mean
+        self._keys[position] = key
+        self._alive[position] = True
+        self._position_of[key] = position
+        self.size += 1
+        self.live += 1
+        self.changes += 1
+
+    def remove(self, key):
+        """Drop a template (its slot stays dead until the next refit)"""
+        position = self._position_of.pop(key, None)
+        if position is None:
+            return False
+        self._alive[position] = False
+        self.live -= 1
+        self.changes += 1
+        return True
+
+    def candidates(self, unit, shortlist=None):
+        """
+        Shortlist rows in PCA space, then rescore them exactly
+
+        Args:
+            unit: (D,) unit probe encoding
+            shortlist: Rows kept after the coarse stage (defaults to self.shortlist)
+
+        Returns:
+            Tuple of (template_keys, similarities, norms) for the shortlist
+        """
+        shortlist = min(shortlist or self.shortlist, self.live)
+        if shortlist == 0:
+            empty = np.empty(0, dtype=np.float32)
+            return [], empty, empty
+
+        alive = self._alive[:self.size]
+        if shortlist < self.live:
+            # u.g = (u - m).(g - m) + g.m + (u.m - m.m); the last term is constant
+            coarse = self._projected[:self.size] @ ((unit - self.mean) @ self.components.T)
+            coarse += self._offsets[:self.size]
+            coarse[~alive] = -np.inf
+            positions = np.argpartition(-coarse, shortlist - 1)[:shortlist]
+        else:
+            positions = np.flatnonzero(alive)
+
+        keys = [int(key) for key in self._keys[positions]]
+        rows = np.array([self.gallery.row_of(key) for key in keys], dtype=np.int64)
+        similarities = self.gallery.unit_vectors(rows) @ np.asarray(unit, dtype=np.float32)
+        return keys, similarities, self.gallery.norms[rows]
@@ -0,0 +1,139 @@
+# Product Quantization
+# Compresses unit face encodings to a few uint8 codes per template
+
+import base64
+import numpy as np
+from ann_index import ASSIGN_CHUNK
+
+
+def kmeans(data, k, iterations=15, seed=0):
+    """
+    Plain (Euclidean) k-means used to train the sub-space codebooks
+
+    Args:
+        data: (N, d) float32 sub-vectors
+        k: Number of codewords (clamped to N)
+        iterations: Lloyd iterations
+        seed: Random seed for the initial codewords
+
+    Returns:
+        (k, d) float32 codewords
+    """
+    rng = np.random.default_rng(seed)
+    k = max(1, min(k, len(data)))
+    centers = data[rng.choice(len(data), k, replace=False)].copy()
+
+    for _ in range(iterations):
+        labels = nearest_codewords(data, centers)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, data)
+        counts = np.bincount(labels, minlength=k)
+
+        # Re-seed empty clusters from random points
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = data[rng.choice(len(data), int(empty.sum()))]
+            counts[empty] = 1
+
+        centers = (sums / counts[:, None]).astype(np.float32)
+
+    return centers
+
+
+def nearest_codewords(data, centers, chunk=ASSIGN_CHUNK):
+    """Index of the nearest codeword (Euclidean) for every row of `data`"""
+    labels = np.empty(len(data), dtype=np.int64)
+    center_sq = np.sum(centers * centers, axis=1)
+    for start in range(0, len(data), chunk):
+        block = data[start:start + chunk]
+        # |x - c|^2 without the constant |x|^2 term
+        labels[start:start + chunk] = np.argmin(center_sq - 2 * block @ centers.T, axis=1)
+    return labels
+
+
+class ProductQuantizer:
+    """
+    Product quantizer over unit-length encodings
+
+    The D-dimensional space is split into `subspaces` blocks, each with its
+    own codebook of up to 256 codewords, so a template is stored as one
+    uint8 per block (16 bytes for 128-d with 16 blocks instead of 512).
+    Similarities are computed asymmetrically: the probe stays in float32
+    and is dotted once with every codeword, then each gallery row is scored
+    by summing table lookups.
+    """
+
+    def __init__(self, dim=128, subspaces=16, codewords=256):
+        if dim % subspaces:
+            raise ValueError(f"dim {dim} is not divisible by {subspaces} subspaces")
+        self.dim = dim
+        self.subspaces = subspaces
+        self.codewords = min(codewords, 256)
+        self.sub_dim = dim // subspaces
+        self.codebooks = None  # (subspaces, codewords, sub_dim)
+
+    def is_trained(self):
+        return self.codebooks is not None
+
+    def _split(self, unit):
+        return unit.reshape(len(unit), self.subspaces, self.sub_dim)
+
+    def train(self, unit, seed=0):
+        """Fit one codebook per sub-space on (N, D) unit encodings"""
+        parts = self._split(np.asarray(unit, dtype=np.float32))
+        books = np.zeros((self.subspaces, self.codewords, self.sub_dim), dtype=np.float32)
+        for j in range(self.subspaces):
+            centers = kmeans(np.ascontiguousarray(parts[:, j]), self.codewords, seed=seed + j)
+            books[j, :len(centers)] = centers
+            # Pad unused codewords with the first one so every code decodes
+            books[j, len(centers):] = centers[0]
+        self.codebooks = books
+        return self
+
+    def encode(self, unit):
+        """(N, D) unit encodings -> (N, subspaces) uint8 codes"""
+        parts = self._split(np.asarray(unit, dtype=np.float32))
+        codes = np.empty((len(parts), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            codes[:, j] = nearest_codewords(np.ascontiguousarray(parts[:, j]), self.codebooks[j])
+        return codes
+
+    def decode(self, codes):
+        """(N, subspaces) codes -> (N, D) reconstructed encodings"""
+        codes = np.asarray(codes, dtype=np.intp)
+        parts = self.codebooks[np.arange(self.subspaces), codes]
+        return parts.reshape(len(codes), self.dim)
+
+    def lookup_tables(self, unit):
+        """(subspaces, codewords) dot products of a unit probe with every codeword"""
+        parts = np.asarray(unit, dtype=np.float32).reshape(self.subspaces, self.sub_dim)
+        return np.einsum('jkd,jd->jk', self.codebooks, parts)
+
+    def similarities(self, codes, unit):
+        """Asymmetric similarities between a float probe and (N, subspaces) codes"""
+        tables = self.lookup_tables(unit)
+        result = np.zeros(len(codes), dtype=np.float32)
+        for j in range(self.subspaces):
+            result += tables[j][codes[:, j]]
+        return result
+
+    def save(self, path):
+        np.savez(path, codebooks=self.codebooks, dim=self.dim, subspaces=self.subspaces)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        quantizer = cls(dim=int(data["dim"]), subspaces=int(data["subspaces"]),
+                        codewords=data["codebooks"].shape[1])
+        quantizer.codebooks = data["codebooks"].astype(np.float32)
+        return quantizer
+
+
+def pack_codes(codes):
+    """uint8 code row -> compact base64 string for JSON storage"""
+    return base64.b64encode(np.asarray(codes, dtype=np.uint8).tobytes()).decode('ascii')
+
+
+def unpack_codes(text):
+    """Inverse of pack_codes"""
+    return np.frombuffer(base64.b64decode(text), dtype=np.uint8)
@@ -0,0 +1,82 @@
+# Verification Result Cache
+# Reuses decisions for byte-identical frames instead of re-running the pipeline
+
+import hashlib
+import threading
+from device_cache import DeviceCache
+
+
+def image_key(image, *params):
+    """
+    Cache key for an uploaded image
+
+    Args:
+        image: Base64 string or raw image bytes (hashed with BLAKE2b, which
+            runs at memory speed, so nothing is decoded)
+        *params: Request options the result also depends on (e.g. top_k)
+
+    Returns:
+        Hashable key
+    """
+    if isinstance(image, str):
+        image = image.encode('utf-8', 'surrogatepass')
+        encoding = 'b64'
+    else:
+        encoding = 'raw'
+    return (encoding, hashlib.blake2b(image, digest_size=16).digest()) + params
+
+
+class ResultCache:
+    """
+    Recent /verify results keyed by image content, tied to one gallery version
+
+    Every entry was computed against the gallery snapshot with the
+    cache's current `version`. Seeing a newer version (a face was added,
+    deleted or compacted) drops all entries, and results computed against
+    an older snapshot are never stored, so a cached decision is always
+    what the current gallery would answer. Entries live in a DeviceCache,
+    so at most `max_entries` are kept and each expires after `ttl` seconds.
+    """
+
+    def __init__(self, max_entries=512, ttl=10.0):
+        self._results = DeviceCache(max_entries, ttl)  # {image_key: result}
+        self._lock = threading.Lock()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self, version):
+        """
+        True if `version` is the cache's version, dropping every entry
+        first when the gallery moved past it (call with _lock held)
+        """
+        if version > self.version:
+            self.version = version
+            self._results.clear()
+        return version == self.version
+
+    def get(self, key, version):
+        """Result cached for `key` under gallery `version`, or None"""
+        with self._lock:
+            result = self._results.get(key) if self._current(version) else None
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def put(self, key, version, result):
+        """Cache `result`, computed against gallery `version`"""
+        with self._lock:
+            if self._current(version):
+                self._results.put(key, result)
+
+    def stats(self):
+        """Hit counters for /status"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._results),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
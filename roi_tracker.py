@@ -0,0 +1,57 @@
+# Per-Camera ROI Tracking
+# Remembers where each fixed camera last saw a face so detection can start there
+
+from device_cache import DeviceCache
+
+
+class ROITracker:
+    """
+    Last face box per device, bounded and expiring
+
+    Door cameras are fixed-mount, so consecutive frames from one device
+    usually show the face close to where it was last time. `region` gives
+    the last box expanded by `margin` (a fraction of the box size on every
+    side) for the detector to search first. Boxes live in a DeviceCache,
+    so at most `max_devices` are kept and each expires after `ttl` seconds.
+    """
+
+    def __init__(self, margin=1.0, max_devices=256, ttl=30.0):
+        self.margin = margin
+        self._boxes = DeviceCache(max_devices, ttl)  # {device_id: (box, frame_shape)}
+
+    def __len__(self):
+        return len(self._boxes)
+
+    def region(self, device_id, shape):
+        """
+        Area to search first for `device_id`
+
+        Args:
+            device_id: Camera identity
+            shape: Shape of the new frame
+
+        Returns:
+            (top, right, bottom, left) search region, or None when there is
+            no recent box for this device (or the frame size changed)
+        """
+        entry = self._boxes.get(device_id)
+        if entry is None:
+            return None
+        box, frame_shape = entry
+        if frame_shape != shape[:2]:
+            self._boxes.pop(device_id)
+            return None
+
+        top, right, bottom, left = box
+        pad_y = int((bottom - top) * self.margin)
+        pad_x = int((right - left) * self.margin)
+        h, w = shape[:2]
+        return (max(0, top - pad_y), min(w, right + pad_x), min(h, bottom + pad_y), max(0, left - pad_x))
+
+    def update(self, device_id, box, shape):
+        """Remember the face box just found for `device_id`"""
+        self._boxes.put(device_id, (tuple(int(v) for v in box), shape[:2]))
+
+    def forget(self, device_id):
+        """Drop the box for `device_id` (no face in its last frame)"""
+        self._boxes.pop(device_id)
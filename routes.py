@@ -3,19 +3,52 @@
 
 from flask import Blueprint, request, jsonify, render_template_string, Response
 from functools import wraps
-from config import RECOGNITION_THRESHOLD
-from face_service import decode_image, detect_faces, encode_face, compare_faces
+from werkzeug.exceptions import RequestEntityTooLarge
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    RECOGNITION_THRESHOLD, MAX_TOP_K, MAX_BATCH_SIZE, BATCH_WORKERS,
+    RESULT_CACHE, RESULT_CACHE_SIZE, RESULT_CACHE_TTL, MAX_UPLOAD_BYTES, FRAME_GATING
+)
+from face_service import (
+    decode_frame, detect_faces, encode_face, active_detector,
+    frame_unchanged, record_frame, face_quality,
+    compare_faces, compare_faces_topk, compare_faces_batch
+)
 from database import (
-    add_face, delete_face, get_all_faces, 
-    get_known_encodings, log_access, get_logs
+    add_face, delete_face, get_all_faces, compact_faces,
+    get_known_encodings, log_access, log_accesses, get_logs
 )
+from face_quality import QUALITY_FAILURES
+from result_cache import ResultCache, image_key
+from ingest import InvalidUpload, UploadTooLarge, IMAGE_TOO_LARGE, read_body, read_json_image
+from image_header import HEADER_REJECTIONS
 from templates import HOME_PAGE, REGISTER_PAGE, APP_PAGE
+from urllib.parse import unquote
 import database
 import os
 
 # Create blueprint for routes
 api = Blueprint('api', __name__)
 
+# Workers for decoding/detecting batched frames (OpenCV releases the GIL)
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+
+# Recent /verify results for byte-identical frames
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL) if RESULT_CACHE else None
+
+# encode_probe failure for a frame identical to the camera's last empty
+# frame: answered as "No face detected" without detection or a log entry
+UNCHANGED_FRAME = "Unchanged frame"
+NO_FACE = "No face detected"
+
+# Request fields carried in headers when the body is the raw image
+UPLOAD_HEADERS = {
+    'name': 'X-Name',
+    'person_id': 'X-Person-ID',
+    'device_id': 'X-Device-ID',
+    'top_k': 'X-Top-K',
+}
+
 # Admin credentials (set via environment variable or default)
 ADMIN_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD', 'smartlock123')
@@ -39,6 +72,59 @@ def admin_required(f):
     return decorated
 
 
+def read_upload():
+    """
+    Fields and image of a /register or /verify request
+    
+    Three body types are accepted:
+        application/json: {"image": "base64_encoded_image", ...fields}
+        image/jpeg (any image/* or application/octet-stream): the image
+            file itself, fields in UPLOAD_HEADERS (URL-encoded)
+        multipart/form-data: an "image" file part, fields as form fields
+    
+    Images are returned as bytes so they go to the decoder without a
+    base64 round trip. Raw and JSON bodies are streamed: the image lands
+    in one preallocated buffer (JSON base64 is decoded on the fly) and
+    reading stops as soon as it passes MAX_UPLOAD_BYTES.
+    
+    Returns:
+        Tuple of (fields dict, image) where image is bytes (a base64
+        string for a multipart text field), or None if the request has
+        no image
+    
+    Raises:
+        InvalidUpload: Malformed body, or UploadTooLarge (also for bodies
+            over MAX_REQUEST_BYTES, which Flask refuses)
+    """
+    try:
+        mimetype = request.mimetype
+        if mimetype.startswith('image/') or mimetype == 'application/octet-stream':
+            fields = {
+                field: unquote(request.headers[header])
+                for field, header in UPLOAD_HEADERS.items()
+                if header in request.headers
+            }
+            return fields, read_body(request.stream, MAX_UPLOAD_BYTES, request.content_length) or None
+        
+        if mimetype == 'multipart/form-data':
+            fields = request.form.to_dict()
+            upload = request.files.get('image')
+            image = upload.read(MAX_UPLOAD_BYTES + 1) if upload else fields.get('image')
+            if upload and len(image) > MAX_UPLOAD_BYTES:
+                raise UploadTooLarge()
+            return fields, image or None
+        
+        if mimetype == 'application/json':
+            return read_json_image(request.stream, MAX_UPLOAD_BYTES, request.content_length)
+        
+        data = request.json
+        if not data:
+            return {}, None
+        return data, data.get('image')
+    except RequestEntityTooLarge:
+        raise UploadTooLarge()
+
+
 @api.route('/')
 def home():
     """Dashboard home page"""
@@ -66,30 +152,43 @@ def register_face():
     """
     Register a new face
     
+    Sending the "person_id" of a registered person adds another template
+    to that person; without it a new person is created. An unknown
+    person_id is an error.
+    
     Request JSON:
-        {"name": "Person Name", "image": "base64_encoded_image"}
+        {"name": "Person Name", "image": "base64_encoded_image",
+         "person_id": str (optional)}
+    The image can also be sent raw (image/jpeg body with X-Name and
+    X-Person-ID headers) or as a multipart upload (see read_upload).
         
     Returns:
         {"success": bool, "id": str, "name": str, "message": str}
     """
     try:
-        data = request.json
+        data, image = read_upload()
         
         # Validate input
-        if not data or 'name' not in data or 'image' not in data:
+        if 'name' not in data or image is None:
             return jsonify({"success": False, "error": "Missing name or image"})
         
         name = data['name'].strip()
         if not name:
             return jsonify({"success": False, "error": "Name cannot be empty"})
         
-        # Decode image
-        image_array = decode_image(data['image'])
-        if image_array is None:
+        person_id = data.get('person_id')
+        if person_id is not None:
+            person_id = str(person_id)
+            if person_id not in database.known_faces:
+                return jsonify({"success": False, "error": f"Unknown person_id {person_id}"})
+        
+        # Decode image (luminance only until a face is found)
+        frame = decode_frame(image)
+        if frame is None:
             return jsonify({"success": False, "error": "Invalid image format"})
         
         # Detect faces
-        face_locations = detect_faces(image_array)
+        face_locations = detect_faces(frame.gray)
         
         if len(face_locations) == 0:
             return jsonify({"success": False, "error": "No face detected in image"})
@@ -97,13 +196,18 @@ def register_face():
         if len(face_locations) > 1:
             return jsonify({"success": False, "error": "Multiple faces detected. Use single face image"})
         
+        # Reject faces that would make a poor template
+        reason = face_quality(frame.gray, face_locations[0])
+        if reason:
+            return jsonify({"success": False, "error": f"{reason}. Please retry with a clearer image", "retry": True})
+        
         # Encode face
-        encoding = encode_face(image_array, face_locations[0])
+        encoding = encode_face(frame.rgb, face_locations[0])
         if encoding is None:
             return jsonify({"success": False, "error": "Could not encode face"})
         
         # Store face
-        face_id = add_face(name, encoding)
+        face_id = add_face(name, encoding, person_id)
         
         return jsonify({
             "success": True,
@@ -116,6 +220,124 @@ def register_face():
         return jsonify({"success": False, "error": str(e)})
 
 
+def encode_probe(image, device_id=None):
+    """
+    Decode an image and encode its first face
+    
+    Args:
+        image: Base64 encoded image or raw image bytes
+        device_id: Optional camera identity (narrows detection to the
+            area of that camera's last face and skips unchanged frames)
+    
+    Returns:
+        Tuple of (encoding, None) on success or (None, failure reason)
+    """
+    # Decode image (luminance only until a face is found)
+    try:
+        frame = decode_frame(image)
+    except InvalidUpload as e:
+        return None, str(e)
+    if frame is None:
+        return None, "Invalid image"
+    
+    # Same empty scene as this camera's last frame
+    if frame_unchanged(frame.gray, device_id):
+        return None, UNCHANGED_FRAME
+    
+    # Detect face
+    face_locations = detect_faces(frame.gray, device_id=device_id)
+    record_frame(frame.gray, device_id, len(face_locations) > 0)
+    if len(face_locations) == 0:
+        return None, NO_FACE
+    
+    # Skip encoding and matching for unusable faces
+    reason = face_quality(frame.gray, face_locations[0])
+    if reason:
+        return None, reason
+    
+    # Encode first face
+    face_encoding = encode_face(frame.rgb, face_locations[0])
+    if face_encoding is None:
+        return None, "Encoding failed"
+    
+    return face_encoding, None
+
+
+def match_probe(face_encoding, failure, known_encodings, known_names, top_k=None):
+    """
+    Turn an encode_probe outcome into a /verify response
+    
+    Args:
+        face_encoding, failure: What encode_probe returned
+        known_encodings, known_names: Gallery snapshot to match against
+        top_k: Number of candidates to return (None = best match only)
+    
+    Returns:
+        Tuple of (response dict, access log entry as (authorized, name,
+        confidence) or None when the attempt isn't logged)
+    """
+    if failure in QUALITY_FAILURES:
+        return {"authorized": False, "name": failure, "confidence": 0, "retry": True}, None
+    if failure in HEADER_REJECTIONS:
+        return {"authorized": False, "name": failure, "confidence": 0}, None
+    if failure:
+        return {"authorized": False, "name": failure, "confidence": 0}, (False, failure, 0)
+    
+    if known_encodings.live_count == 0:
+        return (
+            {"authorized": False, "name": "No registered faces", "confidence": 0},
+            (False, "No registered faces", 0)
+        )
+    
+    # Compare faces
+    if top_k:
+        candidates, margin, is_match = compare_faces_topk(
+            known_encodings,
+            face_encoding,
+            top_k,
+            RECOGNITION_THRESHOLD
+        )
+        # An ANN index can come back without candidates: treat as no match
+        best_idx, distance = candidates[0] if candidates else (-1, 1.0)
+    else:
+        best_idx, distance, is_match = compare_faces(
+            known_encodings, 
+            face_encoding, 
+            RECOGNITION_THRESHOLD
+        )
+    
+    confidence = 1 - distance
+    
+    if is_match:
+        name = known_names[best_idx]
+        attempt = (True, name, confidence)
+        result = {
+            "authorized": True,
+            "name": name,
+            "confidence": round(confidence, 3)
+        }
+    else:
+        attempt = (False, "Unknown face", confidence)
+        result = {
+            "authorized": False,
+            "name": "Unknown",
+            "confidence": round(confidence, 3)
+        }
+    
+    if top_k:
+        result["candidates"] = [
+            {
+                "id": known_encodings.ids[idx],
+                "name": known_names[idx],
+                "distance": round(dist, 4)
+            }
+            for idx, dist in candidates
+        ]
+        result["margin"] = round(margin, 4) if margin is not None else None
+    
+    return result, attempt
+
+
 @api.route('/verify', methods=['POST'])
 def verify_face():
     """
@@ -123,72 +345,149 @@ def verify_face():
     Used by ESP32-CAM
     
     Request JSON:
-        {"image": "base64_encoded_image"}
+        {"image": "base64_encoded_image", "top_k": int (optional),
+         "device_id": str (optional, or an X-Device-ID header)}
+    The image can also be sent raw (image/jpeg body with X-Device-ID and
+    X-Top-K headers) or as a multipart upload (see read_upload).
         
     Returns:
         {"authorized": bool, "name": str, "confidence": float}
+        With top_k, also "candidates": [{"id", "name", "distance"}] nearest
+        first and "margin" (distance gap between the top two candidates).
+        A face too small, blurred or badly exposed to match gets
+        "retry": true with the reason as "name" (not logged).
+        Frames refused from their header (too large, too small, malformed)
+        get the reason as "name" and aren't logged either.
+    
+    A frame byte-identical to one the same camera sent in the last
+    RESULT_CACHE_TTL seconds gets the same answer from result_cache
+    without decoding, as long as the gallery hasn't changed since. It is
+    logged like any other attempt, except repeats of a camera's empty
+    frame, which frame gating wouldn't log either.
     """
     try:
-        data = request.json
+        try:
+            data, image = read_upload()
+        except InvalidUpload as e:
+            if str(e) not in HEADER_REJECTIONS:
+                log_access(False, str(e))
+            return jsonify({"authorized": False, "name": str(e), "confidence": 0})
         
-        if not data or 'image' not in data:
+        if image is None:
             log_access(False, "No image")
             return jsonify({"authorized": False, "name": "No image", "confidence": 0})
         
-        # Decode image
-        image_array = decode_image(data['image'])
-        if image_array is None:
-            log_access(False, "Invalid image")
-            return jsonify({"authorized": False, "name": "Invalid image", "confidence": 0})
+        device_id = data.get('device_id') or request.headers.get('X-Device-ID')
+        top_k = data.get('top_k')
+        top_k = max(1, min(int(top_k), MAX_TOP_K)) if top_k else None
         
-        # Detect face
-        face_locations = detect_faces(image_array)
+        # Match against the snapshot whose version keys the cache
+        known_encodings, known_names = get_known_encodings()
         
-        if len(face_locations) == 0:
-            log_access(False, "No face detected")
-            return jsonify({"authorized": False, "name": "No face detected", "confidence": 0})
+        key = image_key(image, top_k, device_id) if result_cache else None
+        cached = result_cache.get(key, known_encodings.version) if result_cache else None
+        if cached:
+            result, attempt = cached
+        else:
+            face_encoding, failure = encode_probe(image, device_id)
+            if failure == UNCHANGED_FRAME:
+                return jsonify({"authorized": False, "name": NO_FACE, "confidence": 0})
+            result, attempt = match_probe(face_encoding, failure, known_encodings, known_names, top_k)
+            if result_cache:
+                # The first empty frame from a camera is logged, its repeats aren't
+                repeat_attempt = None if failure == NO_FACE and device_id and FRAME_GATING else attempt
+                result_cache.put(key, known_encodings.version, (result, repeat_attempt))
+        
+        if attempt:
+            log_access(*attempt)
+        return jsonify(result)
+            
+    except Exception as e:
+        log_access(False, f"Error: {str(e)}")
+        return jsonify({"authorized": False, "name": "Error", "confidence": 0, "error": str(e)})
+
+
+@api.route('/verify/batch', methods=['POST'])
+def verify_faces_batch():
+    """
+    Verify several frames in one call
+    Used by gateways that collect frames from multiple door cameras
+    
+    Images are decoded and detected in parallel, all probes are matched
+    with one matrix-matrix product and the log is written once.
+    
+    Request JSON:
+        {"images": ["base64_encoded_image", ...],
+         "device_ids": [str, ...] (optional, one per image)}
         
-        # Encode first face
-        face_encoding = encode_face(image_array, face_locations[0])
-        if face_encoding is None:
-            log_access(False, "Encoding failed")
-            return jsonify({"authorized": False, "name": "Encoding failed", "confidence": 0})
+    Returns:
+        {"results": [{"authorized": bool, "name": str, "confidence": float}, ...]}
+        in the same order as the images
+    """
+    try:
+        try:
+            data = request.json
+        except RequestEntityTooLarge:
+            # Over MAX_REQUEST_BYTES: refused like an oversized /verify image, not logged
+            return jsonify({"results": [], "error": IMAGE_TOO_LARGE})
+        images = data.get('images') if data else None
         
-        # Get known faces
-        known_encodings, known_names = get_known_encodings()
+        if not images or not isinstance(images, list):
+            log_access(False, "No image")
+            return jsonify({"results": [], "error": "Missing images"})
         
-        if not known_encodings:
-            log_access(False, "No registered faces")
-            return jsonify({"authorized": False, "name": "No registered faces", "confidence": 0})
+        if len(images) > MAX_BATCH_SIZE:
+            return jsonify({"results": [], "error": f"At most {MAX_BATCH_SIZE} images per batch"})
         
-        # Compare faces
-        best_idx, distance, is_match = compare_faces(
-            known_encodings, 
-            face_encoding, 
-            RECOGNITION_THRESHOLD
-        )
+        device_ids = data.get('device_ids') or [None] * len(images)
+        if len(device_ids) != len(images):
+            return jsonify({"results": [], "error": "device_ids must match images"})
         
-        confidence = 1 - distance
+        probes = list(batch_pool.map(encode_probe, images, device_ids))
         
-        if is_match:
-            name = known_names[best_idx]
-            log_access(True, name, confidence)
-            return jsonify({
-                "authorized": True,
-                "name": name,
-                "confidence": round(confidence, 3)
-            })
-        else:
-            log_access(False, "Unknown face", confidence)
-            return jsonify({
-                "authorized": False,
-                "name": "Unknown",
-                "confidence": round(confidence, 3)
-            })
+        # Match every encoded probe in one pass
+        known_encodings, known_names = get_known_encodings()
+        encoded = [encoding for encoding, failure in probes if failure is None]
+        matches = iter(compare_faces_batch(known_encodings, encoded, RECOGNITION_THRESHOLD))
+        
+        attempts, results = [], []
+        for encoding, failure in probes:
+            if failure is None and known_encodings.live_count == 0:
+                failure = "No registered faces"
+                next(matches)
             
+            if failure == UNCHANGED_FRAME:
+                # Nothing changed since the last empty frame: not logged again
+                results.append({"authorized": False, "name": NO_FACE, "confidence": 0})
+                continue
+            if failure in QUALITY_FAILURES:
+                results.append({"authorized": False, "name": failure, "confidence": 0, "retry": True})
+                continue
+            if failure in HEADER_REJECTIONS:
+                results.append({"authorized": False, "name": failure, "confidence": 0})
+                continue
+            if failure:
+                attempts.append((False, failure, 0))
+                results.append({"authorized": False, "name": failure, "confidence": 0})
+                continue
+            
+            best_idx, distance, is_match = next(matches)
+            confidence = 1 - distance
+            if is_match:
+                name = known_names[best_idx]
+                attempts.append((True, name, confidence))
+                results.append({"authorized": True, "name": name, "confidence": round(confidence, 3)})
+            else:
+                attempts.append((False, "Unknown face", confidence))
+                results.append({"authorized": False, "name": "Unknown", "confidence": round(confidence, 3)})
+        
+        if attempts:
+            log_accesses(attempts)
+        return jsonify({"results": results})
+        
     except Exception as e:
         log_access(False, f"Error: {str(e)}")
-        return jsonify({"authorized": False, "name": "Error", "confidence": 0, "error": str(e)})
+        return jsonify({"results": [], "error": str(e)})
 
 
 @api.route('/faces', methods=['GET'])
@@ -207,8 +506,33 @@ def remove_face(face_id):
     return jsonify({"success": False, "error": "Face not found"})
 
 
+@api.route('/faces/compact', methods=['POST'])
+@admin_required
+def compact_templates():
+    """Reduce each person's templates to a representative set (admin only)"""
+    data = request.get_json(silent=True) or {}
+    max_templates = data.get('max_templates')
+    if max_templates is not None and (
+        not isinstance(max_templates, int) or isinstance(max_templates, bool) or max_templates < 1
+    ):
+        return jsonify({"success": False, "error": "max_templates must be a positive integer"}), 400
+    removed = compact_faces(max_templates)
+    return jsonify({"success": True, "removed": removed})
+
+
 @api.route('/logs', methods=['GET'])
 @admin_required
 def access_logs():
     """Get access logs (admin only)"""
     return jsonify(get_logs())
+
+
+@api.route('/status', methods=['GET'])
+def server_status():
+    """Active detector backend, gallery size and result cache counters"""
+    return jsonify({
+        "detector": active_detector(),
+        "faces": len(database.known_faces),
+        "gallery_version": database.gallery_version,
+        "result_cache": result_cache.stats() if result_cache else None
+    })
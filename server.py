@@ -3,13 +3,15 @@
 
 from flask import Flask
 from flask_cors import CORS
-from config import HOST, PORT, DEBUG
+from config import HOST, PORT, DEBUG, MAX_REQUEST_BYTES
 from routes import api
 import database
+import face_service
 
 def create_app():
     """Create and configure the Flask application"""
     application = Flask(__name__)
+    application.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
     CORS(application)
     
     # Register routes
@@ -19,6 +21,9 @@ def create_app():
     database.load_faces()
     database.load_logs()
     
+    # Parse the detector before the first request arrives
+    face_service.warm_detector()
+    
     return application
 
 # Create app instance for Gunicorn (cloud deployment)
@@ -43,14 +48,21 @@ def main():
     print(f"[*] Registration UI: http://localhost:{PORT}/register-ui")
     print(f"[*] Full App UI:     http://localhost:{PORT}/app")
     print("\n[*] Endpoints:")
-    print("   POST /register  - Register new face")
-    print("   POST /verify    - Verify face (ESP32)")
-    print("   GET  /faces     - List registered faces")
-    print("   GET  /logs      - View access history")
+    print("   POST   /register       - Register new face")
+    print("   POST   /verify         - Verify face (ESP32)")
+    print("   POST   /verify/batch   - Verify several frames at once")
+    print("   GET    /faces          - List registered faces")
+    print("   DELETE /faces/<id>     - Delete a registered face")
+    print("   POST   /faces/compact  - Compact per-person templates")
+    print("   GET    /logs           - View access history")
+    print("   GET    /status         - Detector, gallery and cache status")
     print("=" * 50 + "\n")
     
     # Run server
-    app.run(host=HOST, port=PORT, debug=DEBUG)
+    try:
+        app.run(host=HOST, port=PORT, debug=DEBUG)
+    finally:
+        database.finish_compaction()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,7 @@
+# Test Setup
+# Makes the server modules (kept at the repository root) importable from tests/
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,172 @@
+# Database Tests
+# Registered faces across deletes, compaction, reloads and storage switches
+
+import json
+import os
+import numpy as np
+import pytest
+import database
+
+STORAGES = ["float32", "mmap", "pq"]
+
+
+@pytest.fixture(autouse=True)
+def fresh_database(tmp_path, monkeypatch):
+    """Empty database in a temporary directory, exact scans, no background compaction"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "PQ_MIN_TRAIN", 20)
+    monkeypatch.setattr(database, "ANN_INDEX", None)
+    monkeypatch.setattr(database, "PERSON_MATCHING", "max")
+    monkeypatch.setattr(database, "TOMBSTONE_COMPACT_RATIO", 2.0)
+    yield
+    database.finish_compaction()
+
+
+def use_storage(monkeypatch, storage):
+    monkeypatch.setattr(database, "GALLERY_STORAGE", storage)
+    database.load_faces()
+
+
+def register(people=30, seed=0):
+    """Register `people` people, every third with a second template; returns {person_id: encodings}"""
+    rng = np.random.default_rng(seed)
+    registered = {}
+    for i in range(people):
+        encoding = rng.normal(size=128).astype(np.float32)
+        person_id = database.add_face(f"p{i}", encoding)
+        registered[person_id] = [encoding]
+        if i % 3 == 0:
+            extra = rng.normal(size=128).astype(np.float32)
+            database.add_face(f"p{i}", extra, person_id=person_id)
+            registered[person_id].append(extra)
+    return registered
+
+
+def assert_registered(registered):
+    """The database holds exactly `registered`, and the published snapshot matches it"""
+    assert set(database.known_faces) == set(registered)
+    for person_id, templates in registered.items():
+        np.testing.assert_allclose(
+            database.template_encodings(person_id), templates, rtol=1e-5, atol=1e-5
+        )
+    snapshot, names = database.get_known_encodings()
+    live = snapshot.alive
+    assert snapshot.live_count == sum(len(t) for t in registered.values())
+    assert set(snapshot.ids[:len(snapshot)][live]) == set(registered)
+    for person_id in registered:
+        assert set(names[:len(snapshot)][live][snapshot.ids[:len(snapshot)][live] == person_id]) == {
+            database.known_faces[person_id]["name"]
+        }
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_tombstone_compact_reload_keeps_identities(monkeypatch, storage):
+    use_storage(monkeypatch, storage)
+    registered = register()
+    for person_id in list(registered)[5:15]:
+        assert database.delete_face(person_id) == (True, f"p{int(person_id) - 1}")
+        del registered[person_id]
+    assert database.gallery.dead > 0
+    assert_registered(registered)
+
+    database.compact_gallery()
+    assert database.gallery.dead == 0
+    assert_registered(registered)
+
+    database.load_faces()
+    assert_registered(registered)
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_deletions_survive_a_reload_before_compaction(monkeypatch, storage):
+    use_storage(monkeypatch, storage)
+    registered = register()
+    database.delete_face("4")
+    del registered["4"]
+    assert os.path.exists(database.DELETED_FACES_FILE)
+
+    database.load_faces()
+    assert_registered(registered)
+
+
+def test_switching_storage_keeps_templates(monkeypatch):
+    use_storage(monkeypatch, "float32")
+    registered = register()
+    for storage in ["mmap", "pq", "float32", "pq", "mmap", "float32"]:
+        use_storage(monkeypatch, storage)
+        assert_registered(registered)
+        entries = json.load(open(database.FACES_FILE))
+        entries.pop("__row_file__", None)
+        stores_rows = storage != "float32"
+        assert all(("rows" in data) == stores_rows for data in entries.values())
+
+
+@pytest.mark.parametrize("storage", STORAGES)
+def test_add_face_to_a_registered_person(monkeypatch, storage):
+    use_storage(monkeypatch, storage)
+    registered = register()
+    encoding = np.ones(128, dtype=np.float32)
+    assert database.add_face("ignored", encoding, person_id="2") == "2"
+    registered["2"].append(encoding)
+    assert database.known_faces["2"]["name"] == "p1"
+    assert_registered(registered)
+
+    with pytest.raises(ValueError):
+        database.add_face("nobody", encoding, person_id="999")
+    assert "999" not in database.known_faces
+
+
+def test_snapshot_is_unaffected_by_later_writes(monkeypatch):
+    use_storage(monkeypatch, "mmap")
+    register()
+    snapshot, _ = database.get_known_encodings()
+    alive = snapshot.alive.copy()
+    before = snapshot.unit_vectors(np.arange(len(snapshot))).copy()
+
+    database.delete_face("1")
+    register(people=40, seed=1)
+    database.compact_gallery()
+
+    np.testing.assert_array_equal(snapshot.alive, alive)
+    np.testing.assert_array_equal(snapshot.unit_vectors(np.arange(len(snapshot))), before)
+    current, _ = database.get_known_encodings()
+    assert "1" not in set(current.ids[:len(current)][current.alive])
+
+
+@pytest.mark.parametrize("storage", ["mmap", "pq"])
+def test_compaction_leaves_one_row_file(monkeypatch, storage):
+    use_storage(monkeypatch, storage)
+    registered = register()
+    for person_id in list(registered)[:10]:
+        database.delete_face(person_id)
+        del registered[person_id]
+    database.compact_gallery()
+
+    row_files = [name for name in os.listdir() if name.endswith(".npy") and name.startswith("gallery_templates")]
+    assert row_files == [database.gallery.path]
+    assert json.load(open(database.FACES_FILE))["__row_file__"] == database.gallery.path
+    database.load_faces()
+    assert_registered(registered)
+
+
+@pytest.mark.parametrize("storage", ["mmap", "pq"])
+def test_failed_save_after_compaction_keeps_the_saved_faces(monkeypatch, storage):
+    use_storage(monkeypatch, storage)
+    registered = register()
+    for person_id in list(registered)[:10]:
+        database.delete_face(person_id)
+        del registered[person_id]
+
+    write_faces = database._write_faces
+
+    def interrupted(path):
+        write_faces(path)
+        raise OSError("disk full")
+
+    monkeypatch.setattr(database, "_write_faces", interrupted)
+    with pytest.raises(OSError):
+        database.compact_gallery()
+    monkeypatch.setattr(database, "_write_faces", write_faces)
+
+    database.load_faces()
+    assert_registered(registered)
@@ -0,0 +1,45 @@
+# Decoder Tests
+# Pillow and OpenCV backends must hand detection frames of the same size
+
+import io
+from functools import lru_cache
+import numpy as np
+import pytest
+from PIL import Image
+from decoders import pil_decode, opencv_decode, cv2
+
+# Sides that are, and aren't, multiples of the reduction factors
+SIZES = [(1024, 768), (1283, 967), (1001, 999), (641, 479)]
+
+
+@lru_cache(maxsize=None)
+def encode(size, format, progressive=False):
+    """Noise image of `size` (width, height), encoded once per test session"""
+    options = {'progressive': True} if progressive else {}
+    pixels = np.random.default_rng(0).integers(0, 256, size[::-1] + (3,), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('reduce', [1, 2, 4, 8])
+def test_jpeg_reduced_size(size, reduce):
+    expected = (-(-size[1] // reduce), -(-size[0] // reduce))
+    assert pil_decode(encode(size, 'JPEG'), 'L', reduce).shape == expected
+
+
+def test_partial_draft_is_not_reduced_twice():
+    # Draft can only scale 3001x2001 by 1/2 here, the other 1/2 comes after
+    assert pil_decode(encode((3001, 2001), 'JPEG'), 'RGB', 4).shape == (501, 751, 3)
+    assert pil_decode(encode((2599, 1999), 'JPEG'), 'RGB', 4).shape == (500, 650, 3)
+
+
+@pytest.mark.skipif(cv2 is None, reason="OpenCV not installed")
+@pytest.mark.parametrize('format, progressive', [('JPEG', False), ('JPEG', True), ('PNG', False)])
+@pytest.mark.parametrize('size', SIZES)
+@pytest.mark.parametrize('reduce', [1, 2, 4, 8])
+@pytest.mark.parametrize('mode', ['L', 'RGB'])
+def test_backends_agree_on_shape(format, progressive, size, reduce, mode):
+    data = encode(size, format, progressive)
+    assert pil_decode(data, mode, reduce).shape == opencv_decode(data, mode, reduce).shape
@@ -0,0 +1,153 @@
+# Gallery Tests
+# Tombstones, compaction, row files and snapshot isolation of the template galleries
+
+import numpy as np
+import pytest
+from gallery import Gallery, MemmapGallery, PQGallery, next_row_file, row_file_generations
+from pca_cascade import PCACascade
+from pq import ProductQuantizer
+
+DIM = 128
+
+
+def encodings(count, seed=0):
+    """`count` random (non-unit) template encodings"""
+    return np.random.default_rng(seed).normal(size=(count, DIM)).astype(np.float32)
+
+
+def filled(gallery, people=40, per_person=2, seed=0):
+    """Add `people` people with `per_person` templates each; returns {person_id: encodings}"""
+    data = encodings(people * per_person, seed).reshape(people, per_person, DIM)
+    for i, templates in enumerate(data):
+        gallery.add(str(i), f"p{i}", templates)
+    return {str(i): templates for i, templates in enumerate(data)}
+
+
+def stored_templates(gallery, person_id):
+    """A person's templates as stored: unit rows scaled back by their norms"""
+    rows = gallery.rows_of(person_id)
+    return gallery.unit_vectors(rows) * gallery.norms[rows][:, None]
+
+
+def trained_quantizer(seed=0):
+    quantizer = ProductQuantizer(subspaces=16, codewords=16)
+    samples = encodings(400, seed)
+    quantizer.train(samples / np.linalg.norm(samples, axis=1, keepdims=True))
+    return quantizer
+
+
+@pytest.fixture(params=["float32", "mmap", "pq"])
+def gallery(request, tmp_path):
+    path = str(tmp_path / "templates.npy")
+    if request.param == "mmap":
+        return MemmapGallery(path=path, chunk_rows=16)
+    if request.param == "pq":
+        return PQGallery(quantizer=trained_quantizer(), path=path, chunk_rows=16)
+    return Gallery()
+
+
+def test_remove_tombstones_rows(gallery):
+    filled(gallery)
+    assert gallery.remove("3")
+    assert not gallery.remove("3")
+    assert gallery.dead == 2
+    assert gallery.live_count == len(gallery) - 2
+    assert "3" not in gallery
+    assert gallery.rows_of("3") == []
+    assert not gallery.alive[gallery.ids[:len(gallery)] == "3"].any()
+
+
+def test_compact_keeps_identities(gallery):
+    people = filled(gallery)
+    for person_id in ("0", "7", "8", "39"):
+        gallery.remove(person_id)
+        del people[person_id]
+    assert gallery.compact() == 8
+    assert gallery.dead == 0
+    assert len(gallery) == gallery.live_count == 2 * len(people)
+    for person_id, templates in people.items():
+        rows = gallery.rows_of(person_id)
+        assert set(gallery.ids[rows]) == {person_id}
+        np.testing.assert_allclose(stored_templates(gallery, person_id), templates, rtol=1e-5, atol=1e-5)
+
+
+def test_row_file_rewrites_use_a_new_generation(tmp_path):
+    path = str(tmp_path / "templates.npy")
+    gallery = MemmapGallery(path=path, capacity=4)
+    filled(gallery, people=10)
+    assert gallery.path != path
+    gallery.discard_retired()
+    assert row_file_generations(path) == [gallery.path]
+
+    gallery.remove("2")
+    old_path = gallery.path
+    gallery.compact()
+    assert gallery.path == next_row_file(old_path)
+    assert sorted(row_file_generations(path)) == sorted([old_path, gallery.path])
+
+
+def test_next_row_file():
+    assert next_row_file("templates.npy") == "templates.1.npy"
+    assert next_row_file("templates.1.npy") == "templates.2.npy"
+    assert next_row_file("data.v2/templates.9.npy") == "data.v2/templates.10.npy"
+
+
+def test_snapshot_is_isolated_from_writes(gallery):
+    people = filled(gallery, people=20)
+    frozen = gallery.snapshot()
+    size = len(frozen)
+
+    gallery.remove("5")
+    filled(gallery, people=60, seed=1)  # overwrites ids "0".."59" and grows the storage
+    gallery.compact()
+
+    assert len(frozen) == size
+    assert frozen.alive.all()
+    for person_id, templates in people.items():
+        found = np.flatnonzero(frozen.ids[:size] == person_id)
+        units = frozen.unit_vectors(found) * frozen.norms[found][:, None]
+        np.testing.assert_allclose(units, templates, rtol=1e-5, atol=1e-5)
+
+
+def test_snapshot_shares_rows_and_copies_the_alive_mask():
+    gallery = Gallery()
+    filled(gallery)
+    frozen = gallery.snapshot()
+    assert np.shares_memory(frozen._store, gallery._store)
+    assert not np.shares_memory(frozen._alive, gallery._alive)
+
+
+def test_pq_gallery_keeps_exact_rows(tmp_path):
+    gallery = PQGallery(quantizer=trained_quantizer(), path=str(tmp_path / "templates.npy"))
+    people = filled(gallery)
+    for person_id, templates in people.items():
+        np.testing.assert_allclose(stored_templates(gallery, person_id), templates, rtol=1e-5, atol=1e-5)
+
+
+def test_pca_cascade_snapshot_keeps_removed_templates():
+    gallery = Gallery()
+    people = filled(gallery, people=300, per_person=1)
+    gallery.attach_index(PCACascade(dims=16, shortlist=40))
+    frozen = gallery.snapshot()
+    probe = people["7"][0] / np.linalg.norm(people["7"][0])
+
+    gallery.remove("7")
+    for i, encoding in enumerate(encodings(100, seed=1)):
+        gallery.add(f"new{i}", "new", encoding)  # grows the index arrays
+
+    keys, similarities, _ = frozen.index.candidates(probe)
+    assert frozen.ids[frozen.row_of(keys[int(np.argmax(similarities))])] == "7"
+    keys, _, _ = gallery.index.candidates(probe)
+    assert "7" not in {gallery.ids[gallery.row_of(key)] for key in keys}
+
+
+def test_pca_cascade_rescores_with_exact_rows(tmp_path):
+    gallery = PQGallery(quantizer=trained_quantizer(), path=str(tmp_path / "templates.npy"))
+    filled(gallery, people=200, per_person=1)
+    gallery.attach_index(PCACascade(dims=16, shortlist=20))
+    probe = encodings(1, seed=5)[0]
+    probe /= np.linalg.norm(probe)
+
+    keys, similarities, _ = gallery.index.candidates(probe)
+    rows = [gallery.row_of(key) for key in keys]
+    np.testing.assert_allclose(similarities, gallery.unit_vectors(rows) @ probe, rtol=1e-5, atol=1e-6)
@@ -0,0 +1,136 @@
+# Image Header Tests
+# JPEG marker walk and PNG IHDR read against images Pillow writes
+
+import io
+import struct
+import numpy as np
+import pytest
+from PIL import Image
+from image_header import (
+    probe_header, probe_jpeg, admit, ImageHeader,
+    IMAGE_TOO_SMALL, INVALID_HEADER
+)
+from ingest import InvalidUpload, UploadTooLarge, IMAGE_TOO_LARGE
+
+
+def encode(mode, size, format='JPEG', **options):
+    """Encode a noise image of `size` (width, height) with Pillow"""
+    channels = {'L': (), 'RGB': (3,), 'RGBA': (4,), 'LA': (2,)}[mode]
+    pixels = np.random.default_rng(0).integers(0, 256, size[::-1] + channels, dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, mode).save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def sof_offset(data):
+    """Offset of the first start-of-frame marker (FF Cx) written by Pillow"""
+    for i in range(2, len(data) - 1):
+        if data[i] == 0xFF and data[i + 1] in (0xC0, 0xC1, 0xC2):
+            return i
+    raise AssertionError("no SOF marker")
+
+
+@pytest.mark.parametrize('mode, components', [('L', 1), ('RGB', 3)])
+@pytest.mark.parametrize('progressive, marker', [(False, 0xC0), (True, 0xC2)])
+def test_baseline_and_progressive_jpeg(mode, components, progressive, marker):
+    data = encode(mode, (321, 123), progressive=progressive)
+    assert data[sof_offset(data) + 1] == marker
+    assert probe_header(data) == ImageHeader('JPEG', 321, 123, components)
+
+
+def test_jpeg_with_exif_and_icc_segments_before_the_frame():
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: the header still reports the stored size
+    data = encode('RGB', (200, 100), exif=exif.tobytes(), icc_profile=b'\0' * 3000)
+    assert probe_header(data) == ImageHeader('JPEG', 200, 100, 3)
+
+
+@pytest.mark.parametrize('fill', [1, 2, 7])
+def test_fill_bytes_before_markers(fill):
+    data = encode('RGB', (64, 48))
+    sof = sof_offset(data)
+    # Fill bytes before the first segment and before the frame header
+    padded = data[:2] + b'\xff' * fill + data[2:sof] + b'\xff' * fill + data[sof:]
+    assert probe_header(padded) == ImageHeader('JPEG', 64, 48, 3)
+
+
+def test_standalone_markers_are_skipped():
+    data = encode('L', (80, 60))
+    assert probe_jpeg(data[:2] + b'\xff\xd0\xff\x01' + data[2:]) == ImageHeader('JPEG', 80, 60, 1)
+
+
+def test_every_truncation_before_the_frame_header_is_invalid():
+    data = encode('RGB', (64, 48))
+    end = sof_offset(data) + 10  # FF Cx, length, precision, height, width, components
+    for length in range(2, end):
+        with pytest.raises(InvalidUpload) as error:
+            probe_header(data[:length])
+        assert str(error.value) == INVALID_HEADER
+    assert probe_header(data[:end]) == ImageHeader('JPEG', 64, 48, 3)
+
+
+def jpeg_segments(*segments):
+    """SOI followed by (marker, payload) segments"""
+    data = b'\xff\xd8'
+    for marker, payload in segments:
+        data += bytes((0xFF, marker)) + struct.pack('>H', len(payload) + 2) + payload
+    return data
+
+
+SOF0 = (0xC0, b'\x08' + struct.pack('>HH', 480, 640) + b'\x03' + b'\x01\x22\x00' * 3)
+
+
+@pytest.mark.parametrize('data', [
+    jpeg_segments((0xE0, b'JFIF\0'), (0xDA, b'\0' * 10), SOF0),    # Scan before any frame header
+    jpeg_segments((0xE0, b'JFIF\0'))[:-7] + b'\x00\x01' + b'\0' * 10,  # Segment length below 2
+    jpeg_segments((0xE0, b'JFIF\0')) + b'\x12\x34' + jpeg_segments(SOF0)[2:],  # Garbage between segments
+    jpeg_segments((0xE0, b'x' * 100))[:50],                          # Segment cut short
+    jpeg_segments((0xC0, b'\x08\x01\xe0')),                          # Frame header cut short
+    b'\xff\xd8',
+])
+def test_malformed_jpeg_headers(data):
+    with pytest.raises(InvalidUpload) as error:
+        probe_header(data)
+    assert str(error.value) == INVALID_HEADER
+
+
+def test_handmade_frame_header():
+    assert probe_header(jpeg_segments((0xE1, b'Exif\0\0'), SOF0)) == ImageHeader('JPEG', 640, 480, 3)
+
+
+@pytest.mark.parametrize('mode, components', [('L', 1), ('LA', 2), ('RGB', 3), ('RGBA', 4)])
+def test_png(mode, components):
+    assert probe_header(encode(mode, (90, 70), 'PNG')) == ImageHeader('PNG', 90, 70, components)
+
+
+def test_palette_png_counts_as_rgb():
+    buffer = io.BytesIO()
+    Image.new('P', (20, 30)).save(buffer, 'PNG')
+    assert probe_header(buffer.getvalue()) == ImageHeader('PNG', 20, 30, 3)
+
+
+def test_truncated_png():
+    data = encode('RGB', (90, 70), 'PNG')
+    for length in (8, 16, 25):
+        with pytest.raises(InvalidUpload):
+            probe_header(data[:length])
+
+
+def test_other_formats_are_left_to_the_decoder():
+    assert probe_header(encode('RGB', (10, 10), 'BMP')) is None
+    assert probe_header(b'') is None
+
+
+def test_admit_bounds():
+    admit(ImageHeader('JPEG', 640, 480, 3), min_side=64, max_pixels=640 * 480)
+    admit(ImageHeader('JPEG', 10, 10, 1), min_side=None, max_pixels=None)
+    with pytest.raises(UploadTooLarge) as error:
+        admit(ImageHeader('JPEG', 641, 480, 3), min_side=64, max_pixels=640 * 480)
+    assert str(error.value) == IMAGE_TOO_LARGE
+    with pytest.raises(InvalidUpload) as error:
+        admit(ImageHeader('JPEG', 640, 63, 3), min_side=64, max_pixels=None)
+    assert str(error.value) == IMAGE_TOO_SMALL
+    for header in (ImageHeader('JPEG', 0, 480, 3), ImageHeader('JPEG', 640, 480, 5)):
+        with pytest.raises(InvalidUpload) as error:
+            admit(header, min_side=None, max_pixels=None)
+        assert str(error.value) == INVALID_HEADER
@@ -0,0 +1,141 @@
+# Ingest Tests
+# Streaming JSON/base64 reader against what json.loads + b64decode would give
+
+import base64
+import io
+import json
+import pytest
+from ingest import (
+    JSONImageReader, InvalidUpload, UploadTooLarge, read_body, read_json_image,
+    INVALID_IMAGE, INVALID_REQUEST, MAX_FIELDS_BYTES
+)
+
+IMAGE = bytes(range(256)) * 3 + b'\xff\xd8'  # 770 bytes: the base64 ends in padding and has slashes
+ENCODED = base64.b64encode(IMAGE)
+
+
+def feed_in_chunks(body, chunk_size, max_bytes=1 << 20, field='image'):
+    """Feed `body` to a JSONImageReader `chunk_size` bytes at a time"""
+    reader = JSONImageReader(field, max_bytes, len(body))
+    for start in range(0, len(body), chunk_size):
+        reader.feed(body[start:start + chunk_size])
+    return reader.close()
+
+
+def json_escaped(encoded, line_length=76):
+    """Base64 as some JSON encoders write it: escaped slashes and \\n line breaks"""
+    lines = [encoded[i:i + line_length] for i in range(0, len(encoded), line_length)]
+    return b'\\n'.join(line.replace(b'/', b'\\/') for line in lines)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 7, 64, 1 << 16])
+def test_image_and_fields_at_every_chunk_boundary(chunk_size):
+    body = b'{"name": "A \\"quoted\\" name", "image": "' + ENCODED + b'", "top_k": 3}'
+    fields, image = feed_in_chunks(body, chunk_size)
+    assert bytes(image) == IMAGE
+    assert fields == {"name": 'A "quoted" name', "top_k": 3}
+
+
+@pytest.mark.parametrize('chunk_size', range(1, 12))
+def test_escapes_and_padding_split_across_chunks(chunk_size):
+    assert b'/' in ENCODED and ENCODED.endswith(b'=')
+    body = b'{"image":"' + json_escaped(ENCODED, 10) + b'"}'
+    fields, image = feed_in_chunks(body, chunk_size)
+    assert bytes(image) == base64.b64decode(json.loads(body)["image"]) == IMAGE
+    assert fields == {}
+
+
+@pytest.mark.parametrize('length, padding', [(768, b''), (767, b'='), (766, b'==')])
+def test_every_padding_length(length, padding):
+    data = IMAGE[:length]
+    encoded = base64.b64encode(data)
+    assert encoded.endswith(padding) and encoded.count(b'=') == len(padding)
+    for chunk_size in (1, 3, len(encoded) - 1):
+        _, image = feed_in_chunks(b'{"image": "' + encoded + b'"}', chunk_size)
+        assert bytes(image) == data
+
+
+@pytest.mark.parametrize('encoded', [
+    ENCODED[:-1],            # Truncated inside the last group
+    ENCODED.rstrip(b'='),    # Unpadded
+    ENCODED[:-4] + b'A',     # One character past a group
+    b'QUJD*!#$',             # Not base64
+    b'QUJD\\u0041AAA',       # Escape other encoders don't put in base64
+])
+def test_malformed_base64_is_an_invalid_image(encoded):
+    for chunk_size in (1, 5, 1 << 16):
+        with pytest.raises(InvalidUpload) as error:
+            feed_in_chunks(b'{"image": "' + encoded + b'"}', chunk_size)
+        assert str(error.value) == INVALID_IMAGE
+
+
+@pytest.mark.parametrize('body', [
+    b'{"image": "' + ENCODED,             # Body ends inside the image
+    b'{"image": "' + ENCODED + b'", ',    # Body ends after it
+    b'{"name": "x", "image": ',
+    b'not json',
+])
+def test_truncated_body_is_an_invalid_request(body):
+    with pytest.raises(InvalidUpload) as error:
+        feed_in_chunks(body, 7)
+    assert str(error.value) == INVALID_REQUEST
+
+
+def test_only_the_top_level_image_key_is_decoded():
+    body = (b'{"meta": {"image": "not base64 at all"}, "list": ["image", {"image": "x"}], '
+            b'"label": "image", "image": "' + ENCODED + b'"}')
+    for chunk_size in (1, 4, 1 << 16):
+        fields, image = feed_in_chunks(body, chunk_size)
+        assert bytes(image) == IMAGE
+        assert fields == {"meta": {"image": "not base64 at all"},
+                          "list": ["image", {"image": "x"}], "label": "image"}
+
+
+def test_nested_image_key_alone_is_not_an_image():
+    fields, image = feed_in_chunks(b'{"meta": {"image": "QUJD"}, "image2": "QUJD"}', 3)
+    assert image is None
+    assert fields == {"meta": {"image": "QUJD"}, "image2": "QUJD"}
+
+
+@pytest.mark.parametrize('body', [b'{"image": null}', b'{"image": ""}', b'{}', b'[1, 2]'])
+def test_missing_or_empty_image(body):
+    fields, image = feed_in_chunks(body, 2)
+    assert image is None
+
+
+def test_custom_field_name():
+    fields, image = feed_in_chunks(b'{"image": 1, "frame": "' + ENCODED + b'"}', 5, field='frame')
+    assert bytes(image) == IMAGE
+    assert fields == {"image": 1}
+
+
+def test_decoded_image_over_the_limit():
+    with pytest.raises(UploadTooLarge):
+        feed_in_chunks(b'{"image": "' + ENCODED + b'"}', 64, max_bytes=len(IMAGE) - 1)
+    _, image = feed_in_chunks(b'{"image": "' + ENCODED + b'"}', 64, max_bytes=len(IMAGE))
+    assert bytes(image) == IMAGE
+
+
+def test_oversized_fields_are_an_invalid_request():
+    body = b'{"note": "' + b'x' * MAX_FIELDS_BYTES + b'", "image": "QUJD"}'
+    with pytest.raises(InvalidUpload) as error:
+        feed_in_chunks(body, 1 << 16)
+    assert str(error.value) == INVALID_REQUEST
+    assert not isinstance(error.value, UploadTooLarge)
+
+
+def test_read_json_image_from_a_stream():
+    body = b'{"device_id": "door", "image": "' + ENCODED + b'"}'
+    fields, image = read_json_image(io.BytesIO(body), 1 << 20, len(body))
+    assert bytes(image) == IMAGE
+    assert fields == {"device_id": "door"}
+
+
+def test_read_body():
+    assert read_body(io.BytesIO(IMAGE), len(IMAGE)) == IMAGE
+    assert read_body(io.BytesIO(IMAGE), len(IMAGE), size_hint=len(IMAGE)) == IMAGE
+    assert read_body(io.BytesIO(b''), 10) == b''
+    with pytest.raises(UploadTooLarge):
+        read_body(io.BytesIO(IMAGE), len(IMAGE) - 1)
+    with pytest.raises(UploadTooLarge):
+        read_body(io.BytesIO(b''), 10, size_hint=11)